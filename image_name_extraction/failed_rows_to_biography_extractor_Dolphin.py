@@ -1,91 +1,93 @@
 import re
 import pandas as pd
 
-def extract_failed_names(log_file_path):
-    """Simple function to extract names with JSON parsing failures and biography extraction errors."""
-    json_failed_names = []
-    biography_error_names = []
-    
+# Both failure messages in one pattern so each log line is scanned once
+_FAILED_NAME_RE = re.compile(
+    r'(?:JSON parsing failed for (?P<json>[^:]+)|Error extracting biography for (?P<bio>[^:]+)):'
+)
+
+def _scan_log(file, json_out, bio_out):
+    """Write failed names to the output files as they are found and collect them in a set."""
+    all_failed_names = set()
+    json_count = 0
+    bio_count = 0
+
+    for line in file:
+        match = _FAILED_NAME_RE.search(line)
+        if not match:
+            continue
+
+        # The branch that matched tells JSON parsing failures from general biography errors
+        name = match.group(match.lastgroup).strip()
+        if match.lastgroup == 'json':
+            json_out.write(name + '\n')
+            json_count += 1
+        else:
+            bio_out.write(name + '\n')
+            bio_count += 1
+        all_failed_names.add(name)
+
+    return all_failed_names, json_count, bio_count
+
+def extract_failed_names(log_file_path, json_out_path, bio_out_path):
+    """Simple function to extract names with JSON parsing failures and biography extraction errors.
+
+    Names are streamed to ``json_out_path`` and ``bio_out_path`` while the log is read, so only
+    the set of unique failed names is kept in memory.
+    """
     # Try different encodings
     encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
     
     for encoding in encodings:
         try:
-            with open(log_file_path, 'r', encoding=encoding, errors='ignore') as file:
-                for line in file:
-                    # Check for JSON parsing failures
-                    if 'JSON parsing failed for' in line:
-                        match = re.search(r'JSON parsing failed for ([^:]+):', line)
-                        if match:
-                            name = match.group(1).strip()
-                            json_failed_names.append(name)
-                    
-                    # Check for general biography extraction errors
-                    elif 'Error extracting biography for' in line:
-                        match = re.search(r'Error extracting biography for ([^:]+):', line)
-                        if match:
-                            name = match.group(1).strip()
-                            biography_error_names.append(name)
+            # Output files are reopened per attempt so a failed encoding leaves no partial names behind
+            with open(log_file_path, 'r', encoding=encoding, errors='ignore') as file, \
+                 open(json_out_path, 'w', encoding='utf-8') as json_out, \
+                 open(bio_out_path, 'w', encoding='utf-8') as bio_out:
+                result = _scan_log(file, json_out, bio_out)
             
             print(f"Successfully read file with encoding: {encoding}")
-            break
+            return result
         except UnicodeDecodeError:
             print(f"Failed to read with encoding: {encoding}")
             continue
-    else:
-        print("Could not read file with any encoding, trying with error handling...")
-        try:
-            with open(log_file_path, 'r', encoding='utf-8', errors='replace') as file:
-                for line in file:
-                    if 'JSON parsing failed for' in line:
-                        match = re.search(r'JSON parsing failed for ([^:]+):', line)
-                        if match:
-                            name = match.group(1).strip()
-                            json_failed_names.append(name)
-                    elif 'Error extracting biography for' in line:
-                        match = re.search(r'Error extracting biography for ([^:]+):', line)
-                        if match:
-                            name = match.group(1).strip()
-                            biography_error_names.append(name)
-        except Exception as e:
-            print(f"Failed to read file: {e}")
-            return [], []
-    
-    return json_failed_names, biography_error_names
+
+    print("Could not read file with any encoding, trying with error handling...")
+    try:
+        with open(log_file_path, 'r', encoding='utf-8', errors='replace') as file, \
+             open(json_out_path, 'w', encoding='utf-8') as json_out, \
+             open(bio_out_path, 'w', encoding='utf-8') as bio_out:
+            return _scan_log(file, json_out, bio_out)
+    except Exception as e:
+        print(f"Failed to read file: {e}")
+        return set(), 0, 0
 
 # Usage example:
 if __name__ == "__main__":
     log_file = r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\biography_extractor_Dolphin.log"
-    json_failures, bio_errors = extract_failed_names(log_file)
-    
-    print(f"Found {len(json_failures)} names with JSON parsing failures:")
-    for name in json_failures:
-        print(f"  - {name}")
-    
-    print(f"\nFound {len(bio_errors)} names with biography extraction errors:")
-    for name in bio_errors:
-        print(f"  - {name}")
-    
-    # Save both to files
-    if json_failures:
-        with open(r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\json_failed_names.txt", 'w', encoding='utf-8') as f:
-            for name in json_failures:
-                f.write(f"{name}\n")
-        print(f"\nJSON failures saved to json_failed_names.txt")
+    json_failed_file = r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\json_failed_names.txt"
+    bio_error_file = r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\bio_error_names.txt"
+
+    # Names are written to both files while the log is scanned
+    all_failed_names, json_count, bio_count = extract_failed_names(log_file, json_failed_file, bio_error_file)
     
-    if bio_errors:
-        with open(r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\bio_error_names.txt", 'w', encoding='utf-8') as f:
-            for name in bio_errors:
-                f.write(f"{name}\n")
-        print(f"Biography errors saved to bio_error_names.txt")
+    print(f"Found {json_count} names with JSON parsing failures (saved to json_failed_names.txt)")
+    print(f"Found {bio_count} names with biography extraction errors (saved to bio_error_names.txt)")
 
     df = pd.read_csv(r'D:\data\HCNC\norway\biographies\storage\Dolphin\output\extracted_all_names_Dolphin_with_chunks.csv', encoding='utf-8')
 
-    # Combine both error lists into one set for efficient lookup
-    all_failed_names = set(json_failures + bio_errors)
-
-    # Extract rows where the name is in either error list
-    failed_rows = df[df['name'].isin(all_failed_names)]
+    # Extract rows where the name is in either error list. Matching on the categories
+    # hashes each unique name once; rows are then selected through the integer codes.
+    names = df['name'].astype('category')
+    failed_codes = names.cat.categories.isin(all_failed_names)
+    if len(failed_codes) == 0:
+        # No names at all (empty frame or all NaN): nothing can match, and there is no code table to index
+        failed_rows = df.iloc[:0]
+    else:
+        codes = names.cat.codes.to_numpy()
+        # Missing names have code -1 and must never match
+        mask = (codes >= 0) & failed_codes[codes]
+        failed_rows = df[mask]
 
     print(f"Found {len(failed_rows)} rows with failed names out of {len(df)} total rows")
 
@@ -93,4 +95,4 @@ if __name__ == "__main__":
     failed_rows.to_csv(r"d:\data\HCNC\norway\biographies\storage\Dolphin\logs\failed_rows.csv", index=False, encoding='utf-8')
 
 
-#python biography_extractor_Dolphin.py "d:\data\HCNC\norway\biographies\storage\Dolphin\logs\failed_rows.csv" "d:\data\HCNC\norway\biographies\storage\Dolphin\logs\biographical_data_failed_rows.json"
\ No newline at end of file
+#python biography_extractor_Dolphin.py "d:\data\HCNC\norway\biographies\storage\Dolphin\logs\failed_rows.csv" "d:\data\HCNC\norway\biographies\storage\Dolphin\logs\biographical_data_failed_rows.json"
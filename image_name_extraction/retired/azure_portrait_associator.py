@@ -6,22 +6,116 @@ with special handling for cross-page biographical entries and robust JSON parsin
 """
 
 import os
-import json
 import re
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
-from openai import AzureOpenAI
+from typing import Dict, List, Set, Tuple, Optional
+from openai import AzureOpenAI, RateLimitError, APITimeoutError
+from json_repair import repair_json
+import orjson
 import argparse
 import logging
 import time
-from collections import defaultdict
+import hashlib
+import threading
+from itertools import groupby
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Precompiled patterns
+_MD_IMG_RE_B = re.compile(rb'!\[.*?\]\(images/[^)]+\)')
+
+# Immediate-name rule: image tag followed (same or next line) by "SURNAME, Given names"
+_IMG_NAME_RE = re.compile(r'!\[\]\(images/(?P<img>[^)]+)\)[ \t]*\n*[ \t]*(?P<name>[A-ZÆØÅ][A-ZÆØÅ\-]+,[ \t]*[^,\n]+)')
+_MD_IMG_PATH_RE = re.compile(r'!\[.*?\]\(images/([^)]+)\)')
+REGEX_CONFIDENCE = 0.95
+
+# Image file suffixes, as a tuple for str.endswith
+_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+
+# Azure OpenAI Batch API polling
+BATCH_TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+BATCH_POLL_MIN_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+
+# On-disk LLM response cache
+DEFAULT_CACHE_DIR = "./.llm_cache"
+
+# Raw responses are saved here when running with --log-level DEBUG
+DEBUG_DIR = Path("debug_responses")
+
+# Realtime API calls
+MAX_PARALLEL_REQUESTS = 10
+MAX_API_ATTEMPTS = 3
+
+# Task rules and output schema appended after the page contents of every prompt
+PROMPT_INSTRUCTIONS = """
+TASK:
+Analyze ALL pages together to associate each portrait/image with the person it most likely depicts.
+
+IMPORTANT (strict pairing rules, in priority order):
+1. **Exact syntax** – Every portrait appears as ![](images/<filename>.jpg). Search **only** for this pattern.  
+2. **Immediate-name rule (highest certainty)** – If the image tag is followed (same line or next non-empty line) by a name whose LASTNAME is in ALL-CAPS, **always pair this image with that name**. Treat this as a 100 % match unless another image intervenes. IMPORTANT: If the name is not in ALL-CAPS, do NOT use it for pairing.
+3. **Paragraph-embedded rule** – If the image tag sits inside a prose paragraph that is clearly describing a person, pair the image with that individual rather than the next standalone name heading.  
+4. **Page-start rule (cross-page)** – When a markdown page *begins* with an image tag, assume the portrait belongs to the person whose name appeared last on the *previous* page. Mark is_cross_page = true and cross_page_type = "image_first_on_next_page". The exeption is if the **Immediate-name rule (highest certainty)** applies, in which case use that name instead. then  Mark is_cross_page = fallse and cross_page_type = "same_page". 
+5. **Conflict handling** – If two images appear back-to-back with no intervening name, or if one name plausibly maps to multiple images, list all possibilities but set associated_person to null and flag for manual review.
+
+CRITICAL: Ensure your response is valid JSON format. Escape all quotes and newlines properly in string values.
+
+For each image found (both referenced in markdown and available in directories), determine:
+- Which person it most likely depicts
+- Whether this is a cross-page association (name on page N, portrait on page N+1)
+- Your confidence level based on proximity and context
+
+Respond with ONLY a valid JSON object (no other text) holding the list under "associations":
+{
+  "associations": [
+    {
+      "image_filename": "actual_image_filename.jpg",
+      "image_page": page_number,
+      "image_directory": "page_directory_name",
+      "referenced_in_markdown": true,
+      "associated_person": "SURNAME, Given Names",
+      "person_page": page_number,
+      "person_directory": "page_directory_name",
+      "confidence": 0.92,
+      "is_cross_page": false,
+      "cross_page_type": "same_page",
+      "reasoning": "Brief explanation without quotes or newlines",
+      "context_evidence": "Relevant text snippet without quotes or newlines"
+    }
+  ]
+}
+
+IMPORTANT (output hygiene):
+- Use only double quotes for JSON strings
+- Do not include newlines or unescaped quotes in string values
+- Replace any quotes in text with single quotes or apostrophes
+- Keep reasoning and context_evidence brief and on single lines
+- If no association can be made, set associated_person to null
+"""
+
+@dataclass
+class PageInfo:
+    """A page directory loaded in the directory scan"""
+    # Hand-written __slots__ (dataclass(slots=True) needs Python 3.10); fields therefore take no defaults
+    __slots__ = ('page_directory', 'page_name', 'page_number', 'md_file', 'images_dir',
+                 'content_bytes', 'available_images', 'content')
+    page_directory: str
+    page_name: str
+    page_number: int
+    md_file: str
+    images_dir: str
+    content_bytes: bytes
+    available_images: List[str]
+    content: Optional[str]
+
 class BookPortraitAssociator:
-    def __init__(self, endpoint: str = None, deployment: str = None, api_key: str = None):
+    def __init__(self, endpoint: str = None, deployment: str = None, api_key: str = None,
+                 cache_dir: Optional[str] = DEFAULT_CACHE_DIR, json_fallback: bool = False):
         # Azure OpenAI configuration
         self.endpoint = endpoint or os.getenv("ENDPOINT_URL", "https://cmdopenaiswe.openai.azure.com/")
         self.deployment = deployment or os.getenv("DEPLOYMENT_NAME", "o4-mini")
@@ -34,37 +128,71 @@ class BookPortraitAssociator:
             api_version="2025-01-01-preview",
         )
         
+        # Responses use JSON mode; the regex/repair extraction is only an opt-in fallback
+        self.json_fallback = json_fallback
+        
+        # Timestamp recorded in results; reset at the start of each process_input run
+        self._run_ts = time.strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Raw LLM responses are cached on disk by prompt hash; None disables the cache
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+    def _cache_key(self, prompt_content: str) -> str:
+        """Cache key for a prompt sent to the current deployment"""
+        return hashlib.sha256((self.deployment + prompt_content).encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Return a cached response, or None on a miss or when caching is disabled"""
+        if not self.cache_dir:
+            return None
+        cache_file = self.cache_dir / f"{key}.txt"
+        try:
+            return cache_file.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+    
+    def _cache_set(self, key: str, response_text: str):
+        """Store a response; written to a temp file first so readers never see a partial entry"""
+        if not self.cache_dir:
+            return
+        cache_file = self.cache_dir / f"{key}.txt"
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_file.write_text(response_text, encoding='utf-8')
+        os.replace(tmp_file, cache_file)
+    
     def get_page_number(self, page_dir_name: str) -> int:
         """Extract page number from page directory name"""
-        match = re.search(r'_(\d+)$', page_dir_name)
-        return int(match.group(1)) if match else 0
+        tail = page_dir_name.rpartition('_')[2]
+        return int(tail) if tail.isdigit() else 0
     
     def get_book_id(self, page_dir_name: str) -> str:
         """Extract book ID from page directory name"""
-        parts = page_dir_name.split('_')
-        if len(parts) >= 4:  # e.g., digibok_2007031501007_0057
-            return '_'.join(parts[:-1])  # Everything except the last part (page number)
-        return page_dir_name
+        # e.g., digibok_2007031501007_0057 -> digibok_2007031501007 (drop the page number)
+        head, sep, tail = page_dir_name.rpartition('_')
+        return head if sep and tail.isdigit() else page_dir_name
     
-    def find_page_directories(self, input_path: Path) -> Dict[str, List[Path]]:
-        """Find all page directories and group by book ID"""
-        books = defaultdict(list)
+    def find_page_directories(self, input_path: Path) -> Dict[str, List[PageInfo]]:
+        """Find all page directories, load them and group by book ID in a single directory walk"""
+        entries = []
         
         logger.info(f"Scanning directory: {input_path}")
         
-        # Look for page directories directly under input path
-        for item in input_path.iterdir():
-            if item.is_dir():
-                # Check if this looks like a page directory
-                expected_md = item / f"{item.name}.md"
-                if expected_md.exists():
-                    book_id = self.get_book_id(item.name)
-                    books[book_id].append(item)
-                    logger.debug(f"Found page directory: {item.name} -> book: {book_id}")
-        
-        # Sort pages by page number within each book
-        for book_id in books:
-            books[book_id].sort(key=lambda x: self.get_page_number(x.name))
+        # Look for page directories directly under input path; DirEntry caches the file type
+        with os.scandir(input_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    page = self._load_page(entry)
+                    if page is not None:
+                        book_id = self.get_book_id(entry.name)
+                        entries.append((book_id, page.page_number, page))
+                        logger.debug(f"Found page directory: {entry.name} -> book: {book_id}")
+        
+        # One sort by (book, page) instead of a sort per book, then group consecutive runs
+        entries.sort(key=lambda e: (e[0], e[1]))
+        books = {book_id: [page for _, _, page in group]
+                 for book_id, group in groupby(entries, key=lambda e: e[0])}
         
         logger.info(f"Found {len(books)} books with total {sum(len(pages) for pages in books.values())} pages")
         for book_id, pages in books.items():
@@ -72,130 +200,135 @@ class BookPortraitAssociator:
         
         return books
     
-    def load_page_content(self, page_dir: Path) -> Optional[Dict]:
-        """Load content from a single page directory"""
-        page_name = page_dir.name
-        md_file = page_dir / f"{page_name}.md"
-        images_dir = page_dir / "images"
-        
-        if not md_file.exists():
-            logger.warning(f"Markdown file not found: {md_file}")
-            return None
+    def _read_bytes(self, path: str) -> bytes:
+        """Read a file in binary mode, skipping text-mode decoding"""
+        with open(path, 'rb') as f:
+            return f.read()
+    
+    def _has_images(self, page: PageInfo) -> bool:
+        """Whether a page has image files or markdown image references"""
+        return bool(page.available_images) or _MD_IMG_RE_B.search(page.content_bytes) is not None
+    
+    def _page_text(self, page: PageInfo) -> str:
+        """Decoded markdown of a page, decoded on first use"""
+        if page.content is None:
+            try:
+                page.content = page.content_bytes.decode('utf-8')
+            except UnicodeDecodeError as e:
+                # One badly encoded page must not fail the whole book
+                logger.warning(f"Page {page.page_name} is not valid UTF-8, replacing undecodable bytes: {e}")
+                page.content = page.content_bytes.decode('utf-8', errors='replace')
+        return page.content
+    
+    def _load_page(self, page_entry: os.DirEntry) -> Optional[PageInfo]:
+        """Load a page directory, or return None if it has no page markdown file"""
+        page_name = page_entry.name
+        md_name = f"{page_name}.md"
         
         try:
-            with open(md_file, 'r', encoding='utf-8') as f:
-                content = f.read()
+            # One listing of the page directory answers both "is there markdown" and "are there images"
+            with os.scandir(page_entry.path) as it:
+                children = {child.name: child for child in it}
             
-            # Get list of image files in the images directory
-            image_files = []
-            if images_dir.exists():
-                for img_file in images_dir.iterdir():
-                    if img_file.is_file() and img_file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-                        image_files.append(img_file.name)
+            md_entry = children.get(md_name)
+            if md_entry is None or not md_entry.is_file():
+                return None
             
-            page_info = {
-                "page_directory": str(page_dir),
-                "page_name": page_name,
-                "page_number": self.get_page_number(page_name),
-                "md_file": str(md_file),
-                "images_dir": str(images_dir),
-                "content": content,
-                "available_images": sorted(image_files)
-            }
+            images_dir = os.path.join(page_entry.path, "images")
+            image_files = []
+            images_entry = children.get("images")
+            if images_entry is not None and images_entry.is_dir():
+                with os.scandir(images_dir) as it:
+                    for entry in it:
+                        if entry.name.lower().endswith(_IMG_EXTS) and entry.is_file():
+                            image_files.append(entry.name)
             
-            return page_info
+            return PageInfo(
+                page_directory=page_entry.path,
+                page_name=page_name,
+                page_number=self.get_page_number(page_name),
+                md_file=md_entry.path,
+                images_dir=images_dir,
+                # Kept as bytes; decoded by _page_text only when the text is needed
+                content_bytes=self._read_bytes(md_entry.path),
+                available_images=sorted(image_files),
+                content=None,
+            )
             
         except Exception as e:
-            logger.error(f"Error loading page {page_dir}: {e}")
+            logger.error(f"Error loading page {page_entry.path}: {e}")
             return None
     
-    def load_book_content(self, page_dirs: List[Path]) -> List[Dict]:
-        """Load content from all pages in the book"""
-        pages = []
-        
-        logger.info(f"Loading content from {len(page_dirs)} pages")
-        
-        for page_dir in page_dirs:
-            page_info = self.load_page_content(page_dir)
-            if page_info:
-                pages.append(page_info)
+    def _scan_json_array(self, text: str) -> Optional[str]:
+        """Return the first balanced JSON array in text using a linear bracket-depth scan"""
+        start = text.find('[')
+        if start == -1:
+            return None
         
-        return pages
+        depth = 0
+        in_str = False
+        esc = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == '\\':
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = True
+            elif ch == '[':
+                depth += 1
+            elif ch == ']':
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+        
+        return None
     
     def extract_json_from_response(self, response_text: str) -> List[Dict]:
         """Robust JSON extraction from LLM response"""
-        # Try to find JSON array in the response
-        json_patterns = [
-            r'\[(?:[^[\]]*|\[[^\]]*\])*\]',  # Match nested JSON arrays
-            r'```json\s*(\[.*?\])\s*```',    # JSON in code blocks
-            r'```\s*(\[.*?\])\s*```',        # JSON in generic code blocks
-        ]
-        
-        for pattern in json_patterns:
-            matches = re.findall(pattern, response_text, re.DOTALL)
-            for match in matches:
-                try:
-                    # Clean up the JSON string
-                    json_str = match.strip()
-                    
-                    # Try to parse it
-                    data = json.loads(json_str)
-                    if isinstance(data, list):
-                        return data
-                except json.JSONDecodeError as e:
-                    logger.debug(f"JSON parse error with pattern {pattern}: {e}")
-                    continue
-        
-        # If no JSON found, try to extract and fix common issues
-        # Look for array-like structures
-        array_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-        if array_match:
-            json_str = array_match.group()
-            
-            # Try to fix common JSON issues
+        # Fast path: the response is already a plain JSON array
+        try:
+            data = orjson.loads(response_text)
+            if isinstance(data, list):
+                return data
+        except orjson.JSONDecodeError:
+            pass
+        
+        # Find the first top-level array without a backtracking regex
+        json_str = self._scan_json_array(response_text)
+        if json_str:
             try:
-                # Replace problematic characters in strings
-                fixed_json = self.fix_json_string(json_str)
-                data = json.loads(fixed_json)
+                data = orjson.loads(json_str)
                 if isinstance(data, list):
                     return data
-            except Exception as e:
-                logger.debug(f"Failed to fix JSON: {e}")
+            except orjson.JSONDecodeError as e:
+                logger.debug(f"JSON parse error in scanned array: {e}")
+        
+        # Repair malformed output (unescaped newlines, trailing commas, single quotes, ...)
+        try:
+            data = repair_json(json_str or response_text, return_objects=True)
+            if isinstance(data, list) and data:
+                return data
+        except Exception as e:
+            logger.debug(f"Failed to repair JSON: {e}")
         
         logger.warning("No valid JSON array found in response")
         return []
     
-    def fix_json_string(self, json_str: str) -> str:
-        """Attempt to fix common JSON formatting issues"""
-        # This is a basic approach - for production, consider using a more robust JSON parser
-        
-        # Replace unescaped quotes in strings (basic approach)
-        # This is a simplified fix and may not handle all cases
-        
-        # Save the original for debugging
-        original = json_str
+    def _build_prompt(self, book_id: str, pages: List[PageInfo], include: Optional[Set[int]] = None) -> str:
+        """Build the cross-page portrait association prompt for a book.
         
-        try:
-            # First, try to identify string values and escape quotes within them
-            # This is a simplified approach
-            
-            # Replace newlines within strings with \\n
-            json_str = re.sub(r'(?<=: ")(.*?)(?=")', lambda m: m.group(1).replace('\n', '\\n').replace('\r', '\\r'), json_str)
-            
-            # Replace unescaped quotes within string values (basic approach)
-            # This is very basic and may not work for all cases
-            
-            return json_str
-            
-        except Exception as e:
-            logger.debug(f"JSON fixing failed: {e}")
-            return original
-    
-    def analyze_book_portraits(self, book_id: str, pages: List[Dict]) -> List[Dict]:
-        """Use Azure OpenAI o1-mini to analyze portraits and names across all pages with cross-page awareness"""
+        pages is the whole book, so page order and neighbours match the source. Only the pages at
+        the indices in include are given in full (default: pages with images and the page before
+        each); runs of other pages collapse into one "omitted" marker carrying their page numbers.
+        """
         
         # Prepare the content for LLM analysis with explicit cross-page context
-        prompt_content = f"""You are analyzing a Norwegian biographical reference work that spans multiple pages. 
+        header = f"""You are analyzing a Norwegian biographical reference work that spans multiple pages. 
 The book ID is: {book_id}
 
 IMPORTANT: Biographical entries sometime span across consecutive pages. Common patterns:
@@ -208,139 +341,301 @@ SURNAME, Given names, profession, biographical details...
 
 Portraits/images are referenced as ![](images/filename.jpg) in the markdown and the actual image files are stored in each page's images/ subdirectory.
 
+Pages are given in sequential order with their real page numbers. Pages with no portraits left to associate are omitted and appear only as an "omitted" marker; they contain no portraits you need to report.
+For cross-page entries, page N+1 is the section numbered N+1; if that page is omitted, do not assume the next section shown is the next page. Page content is not repeated elsewhere.
+
 PAGES TO ANALYZE (in sequential order):
 """
         
+        parts = [header]
+        omitted = []  # page numbers of the current run of omitted pages
         for i, page in enumerate(pages):
-            prompt_content += f"""
---- PAGE {page['page_number']} (Directory: {page['page_name']}) ---
-Available images in this page: {', '.join(page['available_images']) if page['available_images'] else 'None'}
+            if include is not None:
+                in_full = i in include
+            else:
+                # Image-less pages only matter as the previous page of a page with images
+                next_has_images = i + 1 < len(pages) and self._has_images(pages[i + 1])
+                in_full = self._has_images(page) or next_has_images
+            if not in_full:
+                omitted.append(page.page_number)
+                continue
+            if omitted:
+                parts.append(self._omitted_marker(omitted))
+                omitted = []
+            parts.append(f"""
+--- PAGE {page.page_number} (Directory: {page.page_name}) ---
+Available images in this page: {', '.join(page.available_images) if page.available_images else 'None'}
 
 Markdown content:
-{page['content']}
-
-"""
-            
-            # Add context about the next page for cross-page analysis
-            if i < len(pages) - 1:
-                next_page = pages[i + 1]
-                # Show first 500 characters of next page to help with cross-page associations
-                next_preview = next_page['content'][:500] + "..." if len(next_page['content']) > 500 else next_page['content']
-                prompt_content += f"""
-[PREVIEW OF NEXT PAGE {next_page['page_number']} - First 500 characters:]
-{next_preview}
-
-"""        
-        prompt_content += """
-TASK:
-Analyze ALL pages together to associate each portrait/image with the person it most likely depicts.
-
-IMPORTANT (strict pairing rules, in priority order):
-1. **Exact syntax** – Every portrait appears as ![](images/<filename>.jpg). Search **only** for this pattern.  
-2. **Immediate-name rule (highest certainty)** – If the image tag is followed (same line or next non-empty line) by a name whose LASTNAME is in ALL-CAPS, **always pair this image with that name**. Treat this as a 100 % match unless another image intervenes. IMPORTANT: If the name is not in ALL-CAPS, do NOT use it for pairing.
-3. **Paragraph-embedded rule** – If the image tag sits inside a prose paragraph that is clearly describing a person, pair the image with that individual rather than the next standalone name heading.  
-4. **Page-start rule (cross-page)** – When a markdown page *begins* with an image tag, assume the portrait belongs to the person whose name appeared last on the *previous* page. Mark is_cross_page = true and cross_page_type = "image_first_on_next_page". The exeption is if the **Immediate-name rule (highest certainty)** applies, in which case use that name instead. then  Mark is_cross_page = fallse and cross_page_type = "same_page". 
-5. **Conflict handling** – If two images appear back-to-back with no intervening name, or if one name plausibly maps to multiple images, list all possibilities but set associated_person to null and flag for manual review.
-
-CRITICAL: Ensure your response is valid JSON format. Escape all quotes and newlines properly in string values.
+{self._page_text(page)}
 
-For each image found (both referenced in markdown and available in directories), determine:
-- Which person it most likely depicts
-- Whether this is a cross-page association (name on page N, portrait on page N+1)
-- Your confidence level based on proximity and context
-
-Respond with ONLY a valid JSON array (no other text):
-[
-  {
-    "image_filename": "actual_image_filename.jpg",
-    "image_page": page_number,
-    "image_directory": "page_directory_name",
-    "referenced_in_markdown": true,
-    "associated_person": "SURNAME, Given Names",
-    "person_page": page_number,
-    "person_directory": "page_directory_name",
-    "confidence": 0.92,
-    "is_cross_page": false,
-    "cross_page_type": "same_page",
-    "reasoning": "Brief explanation without quotes or newlines",
-    "context_evidence": "Relevant text snippet without quotes or newlines"
-  }
-]
-
-IMPORTANT (output hygiene):
-- Use only double quotes for JSON strings
-- Do not include newlines or unescaped quotes in string values
-- Replace any quotes in text with single quotes or apostrophes
-- Keep reasoning and context_evidence brief and on single lines
-- If no association can be made, set associated_person to null
-"""
+""")
+        if omitted:
+            parts.append(self._omitted_marker(omitted))
+        parts.append(PROMPT_INSTRUCTIONS)
+        return "".join(parts)
+    
+    def _omitted_marker(self, page_numbers: List[int]) -> str:
+        """Prompt marker standing in for a run of omitted pages"""
+        if len(page_numbers) == 1:
+            return f"\n--- PAGE {page_numbers[0]}: omitted, no portraits to associate ---\n"
+        return f"\n--- PAGES {page_numbers[0]}-{page_numbers[-1]}: omitted, no portraits to associate ---\n"
+    
+    def _chat_messages(self, prompt_content: str) -> List[Dict]:
+        """Wrap a prompt as a chat message list"""
+        return [
+            {
+                "role": "user", 
+                "content": prompt_content
+            }
+        ]
+    
+    def _load_associations(self, response_text: str) -> Optional[List[Dict]]:
+        """Parse a JSON-mode response of the form {"associations": [...]}; None if it cannot be parsed"""
         try:
-            # Prepare the chat prompt
-            messages = [
-                {
-                    "role": "user", 
-                    "content": prompt_content
-                }
-            ]
-            
-            # Generate the completion
-            completion = self.client.chat.completions.create(
-                model=self.deployment,
-                messages=messages,
-                max_completion_tokens=50000,  # Reduced to avoid overly long responses
-                stop=None,
-                stream=False
-            )
-            
-            response_text = completion.choices[0].message.content
+            data = orjson.loads(response_text)
+            if isinstance(data, dict):
+                associations = data.get("associations", [])
+                if isinstance(associations, list):
+                    return associations
+            elif isinstance(data, list):
+                return data
+        except orjson.JSONDecodeError as e:
+            logger.debug(f"Response is not valid JSON: {e}")
+        
+        if self.json_fallback:
+            # Extract JSON from response using robust method; an empty extraction counts as a failure
+            return self.extract_json_from_response(response_text) or None
+        return None
+    
+    def _parse_associations(self, book_id: str, response_text: str) -> Optional[List[Dict]]:
+        """Extract associations from a raw model response and tag them with the book ID; None if unparseable"""
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Raw Azure OpenAI Response for {book_id}: {response_text[:500]}...")
             
-            # Save raw response for debugging
-            debug_file = Path("debug_response.txt")
-            with open(debug_file, 'w', encoding='utf-8') as f:
+            # Save raw response for debugging, one file per book so concurrent workers don't clobber each other
+            DEBUG_DIR.mkdir(parents=True, exist_ok=True)
+            with open(DEBUG_DIR / f"{book_id}.txt", 'w', encoding='utf-8') as f:
                 f.write(f"Book: {book_id}\n")
                 f.write(f"Response:\n{response_text}\n")
+        
+        associations = self._load_associations(response_text)
+        
+        if associations is None:
+            logger.warning(f"Could not parse the response for {book_id}")
+            return None
+        
+        if associations:
+            # Add book ID to each association
+            for assoc in associations:
+                assoc["book_id"] = book_id
+            
+            logger.info(f"Successfully extracted {len(associations)} associations")
+            return associations
+        
+        logger.warning(f"No valid associations extracted from response for {book_id}")
+        return []
+    
+    def _regex_associate(self, pages: List[PageInfo]) -> Tuple[List[Dict], Set[int]]:
+        """Pair images with the ALL-CAPS name that immediately follows them.
+        
+        Returns (high_confidence, needs_llm_idx): the associations found deterministically, and the
+        indices of the pages that still need the LLM. A page needs the LLM when any of its images is
+        not covered by an immediate-name match; the preceding page is included as cross-page context.
+        """
+        high_confidence = []
+        needs_llm_idx = set()
+        
+        for i, page in enumerate(pages):
+            # Pages without images need neither decoding nor the LLM
+            if not self._has_images(page):
+                continue
             
-            # Extract JSON from response using robust method
-            associations = self.extract_json_from_response(response_text)
+            content = self._page_text(page)
+            matched = set()
+            for match in _IMG_NAME_RE.finditer(content):
+                img = match.group('img')
+                if img in matched:
+                    continue
+                matched.add(img)
+                high_confidence.append({
+                    "image_filename": img,
+                    "image_page": page.page_number,
+                    "image_directory": page.page_name,
+                    "referenced_in_markdown": True,
+                    "associated_person": match.group('name').strip(),
+                    "person_page": page.page_number,
+                    "person_directory": page.page_name,
+                    "confidence": REGEX_CONFIDENCE,
+                    "is_cross_page": False,
+                    "cross_page_type": "same_page",
+                    "reasoning": "Immediate-name rule: ALL-CAPS name directly follows the image tag",
+                    "context_evidence": match.group('name').strip()
+                })
             
-            if associations:
-                # Add book ID to each association
-                for assoc in associations:
-                    assoc["book_id"] = book_id
+            referenced = {img.split('/')[-1] for img in _MD_IMG_PATH_RE.findall(content)}
+            if (referenced | set(page.available_images)) - matched:
+                needs_llm_idx.add(i)
+                if i > 0:
+                    needs_llm_idx.add(i - 1)
+        
+        return high_confidence, needs_llm_idx
+    
+    def _merge_associations(self, book_id: str, regex_associations: List[Dict], llm_associations: List[Dict]) -> List[Dict]:
+        """Combine regex and LLM associations, keeping the regex result for images found by both"""
+        regex_images = {a["image_filename"] for a in regex_associations}
+        associations = list(regex_associations)
+        associations.extend(a for a in llm_associations if a.get("image_filename") not in regex_images)
+        for assoc in associations:
+            assoc["book_id"] = book_id
+        return associations
+    
+    def analyze_book_portraits(self, book_id: str, pages: List[PageInfo]) -> List[Dict]:
+        """Use Azure OpenAI o1-mini to analyze portraits and names across all pages with cross-page awareness"""
+        # Deterministic pre-pass; only pages with unresolved images go to the LLM
+        regex_associations, llm_idx = self._regex_associate(pages)
+        logger.info(f"Book {book_id}: {len(regex_associations)} regex associations, {len(llm_idx)} pages sent to LLM")
+        
+        llm_associations = self._complete(book_id, self._build_prompt(book_id, pages, llm_idx)) if llm_idx else []
+        return self._merge_associations(book_id, regex_associations, llm_associations)
+    
+    def _complete(self, book_id: str, prompt_content: str) -> List[Dict]:
+        """Send a prompt to Azure OpenAI with retries and return the parsed associations"""
+        cache_key = self._cache_key(prompt_content)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            associations = self._parse_associations(book_id, cached)
+            if associations is not None:
+                logger.info(f"Using cached response for book {book_id}")
+                return associations
+        
+        for attempt in range(MAX_API_ATTEMPTS):
+            try:
+                # Generate the completion using streaming
+                completion = self.client.chat.completions.create(
+                    model=self.deployment,
+                    messages=self._chat_messages(prompt_content),
+                    max_completion_tokens=50000,  # Reduced to avoid overly long responses
+                    response_format={"type": "json_object"},
+                    stop=None,
+                    stream=True
+                )
+                
+                parts = []
+                for chunk in completion:
+                    # Azure sends content-filter chunks without choices
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
                 
-                logger.info(f"Successfully extracted {len(associations)} associations")
+                response_text = "".join(parts)
+                associations = self._parse_associations(book_id, response_text)
+                if associations is None:
+                    # Not cached, so the next run asks again
+                    return []
+                self._cache_set(cache_key, response_text)
                 return associations
-            else:
-                logger.warning(f"No valid associations extracted from response for {book_id}")
+            
+            except (RateLimitError, APITimeoutError) as e:
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    logger.error(f"Giving up on book {book_id} after {MAX_API_ATTEMPTS} attempts: {e}")
+                    break
+                delay = 2 ** (attempt + 1)
+                logger.warning(f"Transient Azure OpenAI error for book {book_id}, retrying in {delay}s: {e}")
+                time.sleep(delay)
                 
-        except Exception as e:
-            logger.error(f"Error in Azure OpenAI analysis for book {book_id}: {e}")
+            except Exception as e:
+                logger.error(f"Error in Azure OpenAI analysis for book {book_id}: {e}")
+                break
         
         return []
     
-    def process_book(self, book_id: str, page_dirs: List[Path]) -> Dict:
-        """Process a single book with cross-page awareness"""
-        logger.info(f"Processing book: {book_id}")
+    def _submit_batch(self, prompts: Dict[str, str]) -> Dict[str, str]:
+        """Run all prompts through the Azure OpenAI Batch API and return response text per book ID"""
+        # One JSONL request line per book, keyed by book ID
+        batch_lines = []
+        for book_id, prompt_content in prompts.items():
+            batch_lines.append(orjson.dumps({
+                "custom_id": book_id,
+                "method": "POST",
+                "url": "/chat/completions",
+                "body": {
+                    "model": self.deployment,
+                    "messages": self._chat_messages(prompt_content),
+                    "max_completion_tokens": 50000,
+                    "response_format": {"type": "json_object"}
+                }
+            }))
+        
+        batch_input = b"\n".join(batch_lines)
+        batch_file = self.client.files.create(
+            file=("portrait_associations_batch.jsonl", batch_input),
+            purpose="batch"
+        )
+        batch_job = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted batch {batch_job.id} with {len(prompts)} books")
+        
+        # Poll with exponential backoff until the job reaches a terminal state
+        delay = BATCH_POLL_MIN_SECONDS
+        while batch_job.status not in BATCH_TERMINAL_STATES:
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            batch_job = self.client.batches.retrieve(batch_job.id)
+            logger.info(f"Batch {batch_job.id} status: {batch_job.status}")
+        
+        if batch_job.status != "completed":
+            raise RuntimeError(f"Batch {batch_job.id} ended with status: {batch_job.status}")
+        
+        if batch_job.error_file_id:
+            logger.warning(f"Batch {batch_job.id} has failed requests, see file {batch_job.error_file_id}")
+        
+        responses = {}
+        if not batch_job.output_file_id:
+            return responses
+        
+        output = self.client.files.content(batch_job.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            book_id = item.get("custom_id")
+            response = item.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.error(f"Batch request failed for book {book_id}: {item.get('error') or response}")
+                continue
+            responses[book_id] = response["body"]["choices"][0]["message"]["content"]
+        
+        return responses
+    
+    def _prepare_book(self, book_id: str, pages: List[PageInfo]) -> Tuple[Optional[Dict], int, int]:
+        """Count a book's images.
         
-        # Load all pages
-        pages = self.load_book_content(page_dirs)
+        Returns (early_result, total_images, total_markdown_images); early_result is set
+        when the book needs no LLM analysis.
+        """
+        logger.info(f"Processing book: {book_id}")
         
         if not pages:
             return {
                 "book_id": book_id,
                 "error": "No pages could be loaded",
-                "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-            }
+                "processing_timestamp": self._run_ts
+            }, 0, 0
         
         # Count total images across all pages
         total_images = 0
         total_markdown_images = 0
         
         for page in pages:
-            total_images += len(page['available_images'])
+            total_images += len(page.available_images)
             # Count images referenced in markdown
-            total_markdown_images += len(re.findall(r'!\[.*?\]\(images/[^)]+\)', page['content']))
+            total_markdown_images += len(_MD_IMG_RE_B.findall(page.content_bytes))
         
         if total_images == 0:
             logger.info(f"No images found in book {book_id}")
@@ -349,51 +644,150 @@ IMPORTANT (output hygiene):
                 "pages_processed": len(pages),
                 "total_images": 0,
                 "associations": [],
-                "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-            }
+                "processing_timestamp": self._run_ts
+            }, 0, total_markdown_images
         
         logger.info(f"Analyzing {total_images} images across {len(pages)} pages with cross-page awareness")
+        return None, total_images, total_markdown_images
+    
+    def _build_book_result(self, book_id: str, pages: List[PageInfo], total_images: int,
+                           total_markdown_images: int, associations: List[Dict]) -> Dict:
+        """Compile the per-book result with cross-page statistics"""
+        # Single pass over the associations for all counters
+        c_cross = c_name_prev = c_cont = c_same = c_conf = c_assoc = 0
+        for a in associations:
+            if a.get("is_cross_page", False):
+                c_cross += 1
+            cross_page_type = a.get("cross_page_type")
+            if cross_page_type == "name_previous_page":
+                c_name_prev += 1
+            elif cross_page_type == "continuation":
+                c_cont += 1
+            elif cross_page_type == "same_page":
+                c_same += 1
+            if a.get("confidence", 0) > 0.6:
+                c_conf += 1
+            if a.get("associated_person"):
+                c_assoc += 1
         
-        # Analyze portraits across all pages
-        associations = self.analyze_book_portraits(book_id, pages)
-        
-        # Compile results with cross-page statistics
         cross_page_stats = {
-            "total_cross_page": len([a for a in associations if a.get("is_cross_page", False)]),
-            "name_previous_page": len([a for a in associations if a.get("cross_page_type") == "name_previous_page"]),
-            "continuation_entries": len([a for a in associations if a.get("cross_page_type") == "continuation"]),
-            "same_page_entries": len([a for a in associations if a.get("cross_page_type") == "same_page"])
+            "total_cross_page": c_cross,
+            "name_previous_page": c_name_prev,
+            "continuation_entries": c_cont,
+            "same_page_entries": c_same
         }
         
         result = {
             "book_id": book_id,
             "pages_processed": len(pages),
-            "page_range": f"{min(p['page_number'] for p in pages)}-{max(p['page_number'] for p in pages)}" if pages else "0-0",
-            "page_directories": [p['page_name'] for p in pages],
+            "page_range": f"{min(p.page_number for p in pages)}-{max(p.page_number for p in pages)}" if pages else "0-0",
+            "page_directories": [p.page_name for p in pages],
             "total_images": total_images,
             "markdown_referenced_images": total_markdown_images,
             "associations": associations,
             "summary": {
                 "total_associations": len(associations),
-                "confident_associations": len([a for a in associations if a.get("confidence", 0) > 0.6]),
+                "confident_associations": c_conf,
                 "cross_page_associations": cross_page_stats["total_cross_page"],
                 "cross_page_breakdown": cross_page_stats,
-                "unassociated_images": len([a for a in associations if not a.get("associated_person")]),
-                "success_rate": f"{(len([a for a in associations if a.get('associated_person')])/len(associations)*100):.1f}%" if associations else "0%"
+                "unassociated_images": len(associations) - c_assoc,
+                "success_rate": f"{(c_assoc/len(associations)*100):.1f}%" if associations else "0%"
             },
             "processing_info": {
                 "model_used": self.deployment,
                 "endpoint": self.endpoint,
                 "cross_page_analysis": True,
-                "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+                "processing_timestamp": self._run_ts
             }
         }
         
         logger.info(f"Book {book_id}: {len(associations)} associations ({cross_page_stats['total_cross_page']} cross-page)")
         return result
     
-    def process_input(self, input_path: str, output_dir: str) -> Dict:
+    def process_book(self, book_id: str, pages: List[PageInfo]) -> Dict:
+        """Process a single book with cross-page awareness"""
+        early_result, total_images, total_markdown_images = self._prepare_book(book_id, pages)
+        if early_result is not None:
+            return early_result
+        
+        # Analyze portraits across all pages
+        associations = self.analyze_book_portraits(book_id, pages)
+        
+        return self._build_book_result(book_id, pages, total_images, total_markdown_images, associations)
+    
+    def _process_books_batch(self, books: Dict[str, List[PageInfo]]) -> Dict[str, Dict]:
+        """Process all books through a single Azure OpenAI batch job"""
+        book_results = {}
+        prepared = {}
+        prompts = {}
+        
+        for book_id, pages in books.items():
+            try:
+                early_result, total_images, total_markdown_images = self._prepare_book(book_id, pages)
+                if early_result is not None:
+                    book_results[book_id] = early_result
+                    continue
+                regex_associations, llm_idx = self._regex_associate(pages)
+                prepared[book_id] = (pages, total_images, total_markdown_images, regex_associations)
+                if llm_idx:
+                    prompts[book_id] = self._build_prompt(book_id, pages, llm_idx)
+            except Exception as e:
+                logger.error(f"Error processing book {book_id}: {e}")
+                book_results[book_id] = {
+                    "error": str(e),
+                    "processing_timestamp": self._run_ts
+                }
+        
+        # Only prompts without a cached response go into the batch job
+        responses = {}
+        cache_keys = {book_id: self._cache_key(prompt) for book_id, prompt in prompts.items()}
+        for book_id, key in cache_keys.items():
+            cached = self._cache_get(key)
+            if cached is not None and self._load_associations(cached) is not None:
+                responses[book_id] = cached
+        pending = {book_id: prompt for book_id, prompt in prompts.items() if book_id not in responses}
+        logger.info(f"{len(responses)} books served from cache, {len(pending)} submitted to batch")
+        
+        # A failed job must not lose the regex, cached and image-less results, so its books are only marked failed
+        batch_error = None
+        if pending:
+            try:
+                responses.update(self._submit_batch(pending))
+            except Exception as e:
+                logger.error(f"Batch job failed, {len(pending)} books left without LLM associations: {e}")
+                batch_error = f"Batch job failed: {e}"
+        
+        for book_id, (pages, total_images, total_markdown_images, regex_associations) in prepared.items():
+            response_text = responses.get(book_id)
+            llm_associations = self._parse_associations(book_id, response_text) if response_text else None
+            error = None
+            if llm_associations is None:
+                llm_associations = []
+                if book_id in prompts:
+                    error = batch_error or ("No response in batch output" if response_text is None
+                                            else "Could not parse the LLM response")
+            elif book_id in pending:
+                # Only responses that parsed are cached, so failed books are asked again next run
+                self._cache_set(cache_keys[book_id], response_text)
+            associations = self._merge_associations(book_id, regex_associations, llm_associations)
+            book_results[book_id] = self._build_book_result(book_id, pages, total_images, total_markdown_images, associations)
+            if error:
+                book_results[book_id]["error"] = error
+        
+        return book_results
+    
+    def _save_book_result(self, output_path: Path, book_id: str, book_result: Dict):
+        """Save an individual book result"""
+        book_output_file = output_path / f"{book_id}_portrait_associations.json"
+        with open(book_output_file, 'wb') as f:
+            f.write(orjson.dumps(book_result, option=orjson.OPT_INDENT_2))
+        
+        logger.info(f"Saved results for {book_id} to {book_output_file}")
+    
+    def process_input(self, input_path: str, output_dir: str, use_batch: bool = True,
+                      max_workers: int = MAX_PARALLEL_REQUESTS) -> Dict:
         """Process input directory containing page directories"""
+        self._run_ts = time.strftime("%Y-%m-%d %H:%M:%S")
         input_path = Path(input_path)
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
@@ -411,36 +805,38 @@ IMPORTANT (output hygiene):
             "input_path": str(input_path),
             "output_path": str(output_path),
             "books_found": len(books),
-            "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "processing_timestamp": self._run_ts,
             "books": {}
         }
         
-        for book_id, page_dirs in books.items():
-            try:
-                book_result = self.process_book(book_id, page_dirs)
+        if use_batch:
+            # All books go out as one batch job instead of one blocking request each
+            for book_id, book_result in self._process_books_batch(books).items():
                 results["books"][book_id] = book_result
-                
-                # Save individual book result
-                book_output_file = output_path / f"{book_id}_portrait_associations.json"
-                with open(book_output_file, 'w', encoding='utf-8') as f:
-                    json.dump(book_result, f, indent=2, ensure_ascii=False)
-                
-                logger.info(f"Saved results for {book_id} to {book_output_file}")
-                
-                # Brief pause between books
-                time.sleep(2)
-                
-            except Exception as e:
-                logger.error(f"Error processing book {book_id}: {e}")
-                results["books"][book_id] = {
-                    "error": str(e),
-                    "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                }
+                self._save_book_result(output_path, book_id, book_result)
+        else:
+            # Requests are network-bound, so threads overlap the per-book API latency
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = {pool.submit(self.process_book, book_id, pages): book_id
+                           for book_id, pages in books.items()}
+                for future in as_completed(futures):
+                    book_id = futures[future]
+                    try:
+                        book_result = future.result()
+                        results["books"][book_id] = book_result
+                        self._save_book_result(output_path, book_id, book_result)
+                        
+                    except Exception as e:
+                        logger.error(f"Error processing book {book_id}: {e}")
+                        results["books"][book_id] = {
+                            "error": str(e),
+                            "processing_timestamp": self._run_ts
+                        }
         
         # Save combined results
         combined_output = output_path / "all_books_portrait_associations.json"
-        with open(combined_output, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        with open(combined_output, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         
         return results
 
@@ -454,6 +850,16 @@ def main():
                        default=os.getenv("DEPLOYMENT_NAME", "o4-mini"))
     parser.add_argument("--api-key", help="Azure OpenAI API key", 
                        default=os.getenv("AZURE_OPENAI_API_KEY"))
+    parser.add_argument("--mode", default="batch", choices=["batch", "realtime"],
+                       help="Submit all books as one Azure OpenAI batch job, or call the API per book")
+    parser.add_argument("--workers", type=int, default=MAX_PARALLEL_REQUESTS,
+                       help="Concurrent API requests in realtime mode")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                       help="Directory for cached LLM responses")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Always call the API and do not cache responses")
+    parser.add_argument("--json-fallback", action="store_true",
+                       help="Try regex extraction and JSON repair when a response is not a valid JSON object")
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     
     args = parser.parse_args()
@@ -474,7 +880,9 @@ def main():
         associator = BookPortraitAssociator(
             endpoint=args.endpoint,
             deployment=args.deployment,
-            api_key=args.api_key
+            api_key=args.api_key,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            json_fallback=args.json_fallback
         )
         
         logger.info(f"Processing input: {args.input_path}")
@@ -482,7 +890,8 @@ def main():
         logger.info(f"Using deployment: {args.deployment}")
         
         # Process the input
-        results = associator.process_input(args.input_path, args.output_dir)
+        results = associator.process_input(args.input_path, args.output_dir, use_batch=args.mode == "batch",
+                                           max_workers=args.workers)
         
         # Print summary
         if "books" in results:
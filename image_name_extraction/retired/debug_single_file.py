@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 """
-Debug script to test Gemini analysis on a single markdown file
+Debug script to test Gemini analysis on one or more markdown files
 """
 
 import os
 import json
+import asyncio
 import sys
 from pathlib import Path
 from google import genai
@@ -14,17 +15,9 @@ from google.genai import types
 sys.path.append(str(Path(__file__).parent.parent))
 from agents.key_vault import KeyVault
 
-def analyze_single_file(md_file_path: str):
+async def analyze_single_file(client: genai.Client, model: str, md_file_path: str):
     """Debug function to analyze a single markdown file"""
     
-    # Get API key
-    vault = KeyVault()    
-    api_key = vault.get_key("SDUGeminiAPI")
-    
-    # Initialize Gemini client
-    client = genai.Client(api_key=api_key)
-    model = "gemini-2.5-flash-lite-preview-06-17"
-    
     # Load the markdown file
     md_path = Path(md_file_path)
     if not md_path.exists():
@@ -81,35 +74,47 @@ If no clear associations found, return empty array [].
             response_mime_type="application/json",
         )
         
-        print("Sending request to Gemini...")
+        print(f"Sending request to Gemini for {md_path.name}...")
         
-        # Generate response using streaming
-        response_text = ""
-        for chunk in client.models.generate_content_stream(
+        # Awaiting the async client lets several files be in flight at once
+        response = await client.aio.models.generate_content(
             model=model,
             contents=contents,
             config=generate_content_config,
-        ):
-            response_text += chunk.text
+        )
+        response_text = response.text
         
-        print("Response received!")
+        print(f"Response received for {md_path.name}!")
         print(f"Raw response: {response_text}")
         
         # Parse JSON response
         try:
             associations = json.loads(response_text)
-            print(f"\nParsed {len(associations)} associations:")
+            print(f"\nParsed {len(associations)} associations from {md_path.name}:")
             for i, assoc in enumerate(associations, 1):
                 print(f"{i}. {assoc}")
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
+            print(f"JSON decode error in {md_path.name}: {e}")
             
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error in {md_path.name}: {e}")
+
+async def analyze_files(md_file_paths):
+    """Analyze all markdown files concurrently"""
+    
+    # Get API key
+    vault = KeyVault()    
+    api_key = vault.get_key("SDUGeminiAPI")
+    
+    # Initialize Gemini client
+    client = genai.Client(api_key=api_key)
+    model = "gemini-2.5-flash-lite-preview-06-17"
+    
+    await asyncio.gather(*[analyze_single_file(client, model, path) for path in md_file_paths])
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python debug_single_file.py <path_to_markdown_file>")
+    if len(sys.argv) < 2:
+        print("Usage: python debug_single_file.py <path_to_markdown_file> [<path_to_markdown_file> ...]")
         print("Example: python debug_single_file.py D:\\data\\HCNC\\norway\\biographies\\storage\\AzureOCR\\digibok_2007031501007__0060\\digibok_2007031501007_0060_azure.md")
     else:
-        analyze_single_file(sys.argv[1])
\ No newline at end of file
+        asyncio.run(analyze_files(sys.argv[1:]))
\ No newline at end of file
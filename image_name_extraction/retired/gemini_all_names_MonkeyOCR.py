@@ -12,23 +12,77 @@ from typing import Dict, List, Tuple, Optional
 import base64
 from google import genai
 from google.genai import types
+from google.genai import errors
 import argparse
 import logging
 import time
+import asyncio
+import hashlib
+import io
+import random
 from collections import defaultdict
-# In Python interactive shell for testing
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from pathlib import Path
-import os
-sys.path.append(str(Path(os.getcwd()).parent))
-from agents.key_vault import KeyVault
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+def _json_loads(data):
+    """Parse JSON text or bytes, with orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj, indent: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON bytes, non-ASCII characters kept as-is"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+
+# Precompiled pattern for JSON recovery
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+# Prompt prefilter: lines that open a biographical entry ("SURNAME, Given names"), plus context
+_BIO_LINE_RE = re.compile(r'^[A-ZÆØÅÄÖ]{2,}[,\s]')
+PREFILTER_CONTEXT_LINES = 2
+PREFILTER_MIN_RATIO = 0.05  # below this share of the page, send the full page instead
+
+# Upper bound on Gemini requests in flight at once (keeps us under the RPM limit)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Realtime mode packs this many books into one prompt to amortize per-call overhead
+BOOKS_PER_PROMPT = 4
+
+# Retry policy for transient Gemini failures (rate limits, overload, hung calls)
+MAX_API_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {429, 500, 503, 504}
+REQUEST_TIMEOUT_SECONDS = 120
+RETRY_MAX_DELAY_SECONDS = 60
+
+# Gemini Batch API polling
+BATCH_TERMINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_POLL_MIN_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+
+# On-disk cache of parsed Gemini entries, keyed by prompt hash
+DEFAULT_CACHE_DIR = "./.llm_cache"
+
+# Page files read in parallel per book (reads are I/O bound, e.g. on network drives)
+PAGE_READ_WORKERS = 16
+
 class BookPortraitAssociator:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                 books_per_prompt: int = BOOKS_PER_PROMPT, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 prefilter: bool = True):
         # Google Gemini configuration
         #self.api_key = api_key or os.getenv("SDUGeminiAPI")
         self.api_key = api_key or os.getenv("AMDGeminiFlashKey")
@@ -38,17 +92,74 @@ class BookPortraitAssociator:
         # Initialize Gemini client
         self.client = genai.Client(api_key=self.api_key)
         self.model = "gemini-2.5-flash-lite-preview-06-17"
-        
-    # ...existing code... (get_page_number, get_book_id, find_page_directories, load_page_content, load_book_content, extract_json_from_response, fix_json_string methods remain unchanged)
+        self.max_concurrency = max_concurrency
+        self.books_per_prompt = max(1, books_per_prompt)
+        self.prefilter = prefilter
+        self._semaphore = None  # created inside the running event loop
+        self._combined_file = None  # all_books_names.jsonl while a JSONL run is active
+        self._failed_books = {}  # book_id -> error for books whose request ultimately failed
+        
+        # Parsed entries are cached on disk by prompt hash; None disables the cache
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+    def _cache_key(self, prompt_content: str) -> str:
+        """Cache key for a single-book prompt sent to the current model"""
+        return hashlib.sha256((self.model + prompt_content).encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[List[Dict]]:
+        """Return cached entries, or None on a miss or when caching is disabled"""
+        if not self.cache_dir:
+            return None
+        cache_file = self.cache_dir / f"{key}.json"
+        try:
+            with open(cache_file, 'rb') as f:
+                return _json_loads(f.read())
+        except FileNotFoundError:
+            return None
+    
+    def _cache_set(self, key: str, biographical_entries: List[Dict]):
+        """Store entries; written to a temp file first so readers never see a partial entry"""
+        if not self.cache_dir:
+            return
+        cache_file = self.cache_dir / f"{key}.json"
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'wb') as f:
+            f.write(_json_dumps(biographical_entries))
+        os.replace(tmp_file, cache_file)
+    
+    # ...existing code... (get_page_number, get_book_id, find_page_directories, load_page_content, load_book_content, extract_json_from_response methods remain unchanged)
+    
+    def _candidate_lines(self, content: str) -> str:
+        """Keep only lines that look like entry headings, with a few lines of context"""
+        lines = content.split('\n')
+        keep = set()
+        for i, line in enumerate(lines):
+            if _BIO_LINE_RE.match(line):
+                keep.update(range(max(0, i - PREFILTER_CONTEXT_LINES), min(len(lines), i + PREFILTER_CONTEXT_LINES + 1)))
+        return '\n'.join(lines[i] for i in sorted(keep))
+    
+    def _page_text(self, page: Dict) -> str:
+        """Page content as sent to the model, prefiltered when enabled"""
+        content = page['content']
+        if not self.prefilter:
+            return content
+        filtered = self._candidate_lines(content)
+        # Suspiciously little left (e.g. headings the pattern misses): send the full page
+        if len(filtered) < PREFILTER_MIN_RATIO * len(content):
+            return content
+        return filtered
     
-    def analyze_book_portraits(self, book_id: str, pages: List[Dict]) -> List[Dict]:
-        """Use Google Gemini to identify all biographical names in sequential order"""
+    def _build_prompt(self, pages: List[Dict]) -> str:
+        """Build the name extraction prompt for one book's pages"""
         
         # Combine all page content
-        all_content = ""
+        parts = []
         for page in pages:
-            all_content += f"\n--- PAGE {page['page_number']} ---\n"
-            all_content += page['content']
+            parts.append(f"\n--- PAGE {page['page_number']} ---\n")
+            parts.append(self._page_text(page))
+        all_content = "".join(parts)
         
         prompt_content = f"""You are analyzing Norwegian biographical text to identify all people with biographical entries.
     
@@ -67,75 +178,224 @@ class BookPortraitAssociator:
       }}
     ]
     """
+        return prompt_content
     
+    def _build_multi_book_prompt(self, books_chunk: List[Tuple[str, List[Dict]]]) -> str:
+        """Build one prompt covering several books, delimited by book ID"""
+        sections = []
+        for book_id, pages in books_chunk:
+            sections.append(f"=== BOOK {book_id} ===")
+            for page in pages:
+                sections.append(f"--- PAGE {page['page_number']} ---")
+                sections.append(self._page_text(page))
+            sections.append("=== END BOOK ===")
+        all_content = "\n".join(sections)
+        
+        prompt_content = f"""You are analyzing Norwegian biographical text to identify all people with biographical entries.
+    The text below contains several books, each between "=== BOOK <book_id> ===" and "=== END BOOK ===".
+    
+    BIOGRAPHICAL TEXT:
+    {all_content}
+    
+    TASK:
+    For each book separately, identify all biographical entries in the text. Look for names where the SURNAME is in ALL-CAPS followed by given names, like "ALGER, Bjørn" or "ALNÆS, Ingeborg". These indicate biographical entries.
+    
+    Return all names of a book in the exact order they appear in that book.
+    
+    Respond with ONLY a valid JSON object with one key per book ID (include books with no names as empty arrays):
+    {{
+      "<book_id>": [
+        {{
+          "person_name": "SURNAME, Given Names"
+        }}
+      ]
+    }}
+    """
+        return prompt_content
+    
+    def _contents(self, prompt_content: str) -> List[types.Content]:
+        """Wrap a prompt as Gemini request contents"""
+        return [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=prompt_content),
+                ],
+            ),
+        ]
+    
+    def _generation_config(self) -> types.GenerateContentConfig:
+        """Generation settings shared by the realtime and batch paths"""
+        # Spotting "SURNAME, Given names" lines needs no reasoning tokens; temperature 0 keeps
+        # output deterministic, which the prompt-hash cache relies on
+        return types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(
+                thinking_budget=0,
+            ),
+            temperature=0.0,
+            response_mime_type="application/json",
+        )
+    
+    def _tag_entries(self, book_id: str, biographical_entries: List[Dict]) -> List[Dict]:
+        """Add the book ID to each entry"""
+        for entry in biographical_entries:
+            entry["book_id"] = book_id
+        return biographical_entries
+    
+    def _parse_entries(self, book_id: str, response_text: str) -> List[Dict]:
+        """Parse the model's JSON array and tag each entry with the book ID; raises ValueError if nothing parses"""
         try:
-            # Prepare content for Gemini
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt_content),
-                    ],
-                ),
-            ]
-            
-            # Configure generation
-            generate_content_config = types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=2996,
-                ),
-                response_mime_type="application/json",
-            )
-            
-            # Generate response using streaming
-            response_text = ""
-            for chunk in self.client.models.generate_content_stream(
-                model=self.model,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                response_text += chunk.text
-            
-
-            
-            biographical_entries = json.loads(response_text)
-            
-            # Add book ID to each entry
-            for entry in biographical_entries:
-                entry["book_id"] = book_id
+            biographical_entries = _json_loads(response_text)
+        except ValueError:  # json and orjson decode errors are both ValueErrors
+            biographical_entries = self.extract_json_from_response(response_text)
+            if not biographical_entries:
+                raise ValueError("No valid JSON array found in response")
+        if not isinstance(biographical_entries, list):
+            raise ValueError("Response is not a JSON array")
+        return self._tag_entries(book_id, biographical_entries)
+    
+    async def _generate(self, prompt_content: str) -> str:
+        """Send one prompt to Gemini and return the full response text"""
+        # One-shot request: nothing consumes partial output, so streaming only adds per-chunk overhead.
+        # The semaphore caps concurrent requests; backoff sleeps happen outside it
+        for attempt in range(MAX_API_ATTEMPTS):
+            try:
+                async with self._semaphore:
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(
+                            model=self.model,
+                            contents=self._contents(prompt_content),
+                            config=self._generation_config(),
+                        ),
+                        timeout=REQUEST_TIMEOUT_SECONDS,
+                    )
+                return response.text
+            except (errors.APIError, asyncio.TimeoutError) as e:
+                if isinstance(e, errors.APIError) and e.code not in RETRYABLE_STATUS_CODES:
+                    raise
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise
+                delay = min(RETRY_MAX_DELAY_SECONDS, 2 ** attempt + random.random())
+                logger.warning(f"Gemini request failed ({e!r}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_API_ATTEMPTS})")
+                await asyncio.sleep(delay)
+    
+    async def analyze_book_portraits(self, book_id: str, prompt_content: str, cache_key: str) -> List[Dict]:
+        """Use Google Gemini to identify all biographical names in sequential order (the caller has checked the cache)"""
+        try:
+            response_text = await self._generate(prompt_content)
+            biographical_entries = self._parse_entries(book_id, response_text)
             
+            self._cache_set(cache_key, biographical_entries)
             return biographical_entries
             
         except Exception as e:
             logger.error(f"Error extracting names for {book_id}: {e}")
+            self._failed_books[book_id] = str(e) or repr(e)
             return []
     
-    def process_book(self, book_id: str, page_dirs: List[Path]) -> Dict:
-        """Process a single book to identify all biographical names"""
+    async def analyze_books_batched(self, books_chunk: List[Tuple[str, List[Dict], str]]) -> Optional[Dict[str, List[Dict]]]:
+        """Identify names for several (book_id, pages, single-book cache key) in one Gemini call; None if the response fails validation"""
+        prompt_content = self._build_multi_book_prompt([(book_id, pages) for book_id, pages, _ in books_chunk])
+        expected_ids = {book_id for book_id, _, _ in books_chunk}
+        
+        try:
+            response_text = await self._generate(prompt_content)
+            data = _json_loads(response_text)
+        except Exception as e:
+            logger.error(f"Error extracting names for books {sorted(expected_ids)}: {e}")
+            return None
         
-        pages = self.load_book_content(page_dirs)
-        if not pages:
-            return {"book_id": book_id, "error": "No pages loaded"}
+        # Every book must come back as its own array, otherwise the caller retries per book
+        if (not isinstance(data, dict) or set(data) != expected_ids
+                or not all(isinstance(entries, list) for entries in data.values())):
+            logger.warning(f"Multi-book response did not match books {sorted(expected_ids)}, falling back to per-book calls")
+            return None
         
-        biographical_entries = self.analyze_book_portraits(book_id, pages)
+        # Cache under each book's single-book prompt so later runs hit regardless of chunking
+        for book_id, _, cache_key in books_chunk:
+            self._cache_set(cache_key, data[book_id])
         
-        return {
+        return {book_id: self._tag_entries(book_id, entries) for book_id, entries in data.items()}
+    
+    async def _submit_batch(self, prompts: Dict[str, str]) -> Dict[str, str]:
+        """Run all prompts through the Gemini Batch API (JSONL file) and return response text per book ID"""
+        # One JSONL line per book, keyed by book ID; an uploaded file has no inline-request size limit
+        generation_config = self._generation_config().model_dump(mode="json", exclude_none=True)
+        lines = [
+            _json_dumps({
+                "key": book_id,
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": prompt_content}]}],
+                    "generation_config": generation_config,
+                },
+            })
+            for book_id, prompt_content in prompts.items()
+        ]
+        batch_file = await self.client.aio.files.upload(
+            file=io.BytesIO(b"\n".join(lines)),
+            config=types.UploadFileConfig(display_name="biography-names", mime_type="jsonl"),
+        )
+        batch_job = await self.client.aio.batches.create(
+            model=self.model,
+            src=batch_file.name,
+            config=types.CreateBatchJobConfig(display_name="biography-names"),
+        )
+        logger.info(f"Submitted batch {batch_job.name} with {len(prompts)} books")
+        
+        # Poll with exponential backoff until the job reaches a terminal state
+        delay = BATCH_POLL_MIN_SECONDS
+        while batch_job.state.name not in BATCH_TERMINAL_STATES:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            batch_job = await self.client.aio.batches.get(name=batch_job.name)
+            logger.info(f"Batch {batch_job.name} state: {batch_job.state.name}")
+        
+        if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch {batch_job.name} ended with state: {batch_job.state.name}")
+        
+        responses = {}
+        output = await self.client.aio.files.download(file=batch_job.dest.file_name)
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = _json_loads(line)
+            book_id = item.get("key")
+            response = item.get("response")
+            if not response or not response.get("candidates"):
+                logger.error(f"Batch request failed for book {book_id}: {item.get('error') or response}")
+                continue
+            parts = response["candidates"][0].get("content", {}).get("parts", [])
+            responses[book_id] = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+        
+        return responses
+    
+    def _book_result(self, book_id: str, biographical_entries: List[Dict]) -> Dict:
+        """Assemble the per-book result record"""
+        book_result = {
             "book_id": book_id,
             "total_entries": len(biographical_entries),
             "biographical_entries": biographical_entries,
             "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
         }
+        if book_id in self._failed_books:
+            book_result["error"] = self._failed_books[book_id]
+        return book_result
+    
     def get_page_number(self, page_dir_name: str) -> int:
         """Extract page number from page directory name"""
-        match = re.search(r'_(\d+)$', page_dir_name)
-        return int(match.group(1)) if match else 0
+        return self._parse_dir_name(page_dir_name)[1]
     
     def get_book_id(self, page_dir_name: str) -> str:
         """Extract book ID from page directory name"""
-        parts = page_dir_name.split('_')
-        if len(parts) >= 4:  # e.g., digibok_2007031501007_0057
-            return '_'.join(parts[:-1])  # Everything except the last part (page number)
-        return page_dir_name
+        return self._parse_dir_name(page_dir_name)[0]
+    
+    def _parse_dir_name(self, page_dir_name: str) -> Tuple[str, int]:
+        """Book ID and page number from one rpartition of the directory name (same rule as azure_portrait_associator)"""
+        # e.g., digibok_2007031501007_0057 -> (digibok_2007031501007, 57); no numeric suffix -> (name, 0)
+        head, sep, tail = page_dir_name.rpartition('_')
+        if sep and tail.isdigit():
+            return head, int(tail)
+        return page_dir_name, 0
     
     def find_page_directories(self, input_path: Path) -> Dict[str, List[Path]]:
         """Find all page directories and group by book ID - only digibook files"""
@@ -146,21 +406,18 @@ class BookPortraitAssociator:
         # Look for page directories directly under input path
         for item in input_path.iterdir():
             if item.is_dir():
-                # Check for markdown files starting with "digibook"
-                possible_md_files = []
-                
-                # Look for any .md files in the directory that start with "digibook"
-                for md_file in item.glob("digibok*.md"):
-                    possible_md_files.append(md_file)
-                
-                if possible_md_files:
-                    book_id = self.get_book_id(item.name)
-                    books[book_id].append(item)
-                    logger.debug(f"Found page directory: {item.name} -> bok: {book_id} (found {len(possible_md_files)} digibok files)")
-        
-        # Sort pages by page number within each book
+                # Only need to know a markdown file starting with "digibok" exists
+                if next(item.glob("digibok*.md"), None) is not None:
+                    book_id, page_number = self._parse_dir_name(item.name)
+                    books[book_id].append((page_number, item))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        md_count = sum(1 for _ in item.glob("digibok*.md"))
+                        logger.debug(f"Found page directory: {item.name} -> bok: {book_id} (found {md_count} digibok files)")
+        
+        # Sort pages by the page number computed during the scan, then drop the key
         for book_id in books:
-            books[book_id].sort(key=lambda x: self.get_page_number(x.name))
+            books[book_id].sort(key=lambda t: t[0])
+            books[book_id] = [page_dir for _, page_dir in books[book_id]]
         
         logger.info(f"Found {len(books)} books with total {sum(len(pages) for pages in books.values())} pages")
         for book_id, pages in books.items():
@@ -172,16 +429,13 @@ class BookPortraitAssociator:
         """Load content from a single page directory - markdown only (digibok files)"""
         page_name = page_dir.name
         
-        # Look for markdown files starting with "digibook"
-        md_files = list(page_dir.glob("digibok*.md"))
+        # Use the first digibook file found (there should typically be only one)
+        md_file = next(page_dir.glob("digibok*.md"), None)
         
-        if not md_files:
+        if md_file is None:
             logger.warning(f"No digibok*.md files found in {page_dir}")
             return None
         
-        # Use the first digibook file found (there should typically be only one)
-        md_file = md_files[0]
-        
         try:
             with open(md_file, 'r', encoding='utf-8') as f:
                 content = f.read()
@@ -202,85 +456,200 @@ class BookPortraitAssociator:
     
     def load_book_content(self, page_dirs: List[Path]) -> List[Dict]:
         """Load content from all pages in the book"""
-        pages = []
-        
         logger.info(f"Loading content from {len(page_dirs)} pages")
         
-        for page_dir in page_dirs:
-            page_info = self.load_page_content(page_dir)
-            if page_info:
-                pages.append(page_info)
+        # map keeps page order; load_page_content handles its own errors
+        with ThreadPoolExecutor(max_workers=min(PAGE_READ_WORKERS, max(1, len(page_dirs)))) as executor:
+            pages = [page_info for page_info in executor.map(self.load_page_content, page_dirs) if page_info]
         
         return pages
     
     def extract_json_from_response(self, response_text: str) -> List[Dict]:
         """Robust JSON extraction from LLM response"""
-        # Try to find JSON array in the response
-        json_patterns = [
-            r'\[(?:[^[\]]*|\[[^\]]*\])*\]',  # Match nested JSON arrays
-            r'```json\s*(\[.*?\])\s*```',    # JSON in code blocks
-            r'```\s*(\[.*?\])\s*```',        # JSON in generic code blocks
-        ]
+        # Try to decode a JSON array starting at each '[' in turn; raw_decode stops
+        # at the end of the first complete value, so trailing text is ignored
+        decoder = json.JSONDecoder()
+        idx = response_text.find('[')
+        while idx != -1:
+            try:
+                data, _ = decoder.raw_decode(response_text, idx)
+                if isinstance(data, list):
+                    return data
+            except ValueError as e:
+                logger.debug(f"JSON parse error at offset {idx}: {e}")
+            idx = response_text.find('[', idx + 1)
         
-        for pattern in json_patterns:
-            matches = re.findall(pattern, response_text, re.DOTALL)
-            for match in matches:
-                try:
-                    # Clean up the JSON string
-                    json_str = match.strip()
-                    
-                    # Try to parse it
-                    data = json.loads(json_str)
-                    if isinstance(data, list):
-                        return data
-                except json.JSONDecodeError as e:
-                    logger.debug(f"JSON parse error with pattern {pattern}: {e}")
-                    continue
-        
-        # If no JSON found, try to extract and fix common issues
-        # Look for array-like structures
-        array_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+        # Last resort: a tolerant parser on the outermost array-like structure, if installed
+        array_match = _JSON_ARRAY_RE.search(response_text)
         if array_match:
-            json_str = array_match.group()
-            
-            # Try to fix common JSON issues
             try:
-                # Replace problematic characters in strings
-                fixed_json = self.fix_json_string(json_str)
-                data = json.loads(fixed_json)
+                import json5
+                data = json5.loads(array_match.group())
                 if isinstance(data, list):
                     return data
+            except ImportError:
+                logger.debug("json5 not installed, skipping tolerant JSON parsing")
             except Exception as e:
-                logger.debug(f"Failed to fix JSON: {e}")
+                logger.debug(f"Failed to parse JSON with json5: {e}")
         
         logger.warning("No valid JSON array found in response")
         return []
+
+    def _save_book_result(self, book_output_file: Path, book_result: Dict):
+        """Write one book's result to its JSON file"""
+        with open(book_output_file, 'wb') as f:
+            f.write(_json_dumps(book_result, indent=True))
     
-    def fix_json_string(self, json_str: str) -> str:
-        """Attempt to fix common JSON formatting issues"""
-        # This is a basic approach - for production, consider using a more robust JSON parser
+    async def _finish_book(self, book_id: str, book_result: Dict, output_path: Path) -> Dict:
+        """Save a book's result file and stream it to the combined JSONL; return what to keep in memory"""
+        # Save individual book result
+        book_output_file = output_path / f"{book_id}_names.json"
+        await asyncio.to_thread(self._save_book_result, book_output_file, book_result)
+        
+        logger.info(f"Found {len(book_result.get('biographical_entries', []))} names in {book_id}")
+        
+        # Failed books also get a marker in failed/, so a rerun can target just those;
+        # a later successful run clears it
+        failed_file = output_path / "failed" / f"{book_id}.json"
+        if "error" in book_result:
+            await asyncio.to_thread(self._save_book_result, failed_file, {"book_id": book_id, "error": book_result["error"]})
+        else:
+            await asyncio.to_thread(failed_file.unlink, missing_ok=True)
         
-        # Save the original for debugging
-        original = json_str
+        if self._combined_file is None:
+            return book_result
         
-        try:
-            # First, try to identify string values and escape quotes within them
-            # This is a simplified approach
-            
-            # Replace newlines within strings with \\n
-            json_str = re.sub(r'(?<=: ")(.*?)(?=")', lambda m: m.group(1).replace('\n', '\\n').replace('\r', '\\r'), json_str)
-            
-            # Replace unescaped quotes within string values (basic approach)
-            # This is very basic and may not work for all cases
-            
-            return json_str
-            
-        except Exception as e:
-            logger.debug(f"JSON fixing failed: {e}")
-            return original
-
-    def process_input(self, input_path: str, output_dir: str) -> Dict:
-        """Process input directory containing page directories"""
+        # Written from the event loop thread only, so lines never interleave
+        self._combined_file.write(_json_dumps({"book_id": book_id, **book_result}) + b"\n")
+        self._combined_file.flush()
+        
+        # Keep only a summary so memory stays bounded by one book
+        if "error" in book_result:
+            return {"book_id": book_id, "error": book_result["error"]}
+        return {"book_id": book_id, "total_entries": book_result.get("total_entries", 0)}
+    
+    async def _process_and_save_chunk(self, chunk: List[Tuple[str, List[Path]]], output_path: Path) -> Dict[str, Dict]:
+        """Process a chunk of books with one marshaled prompt and save each book's result file"""
+        book_results = {}
+        loaded = []
+        
+        # File reads run in a worker thread so the event loop keeps other chunks moving
+        for book_id, page_dirs in chunk:
+            pages = await asyncio.to_thread(self.load_book_content, page_dirs)
+            if pages:
+                loaded.append((book_id, pages))
+            else:
+                book_results[book_id] = {"book_id": book_id, "error": "No pages loaded"}
+        
+        # Cached books are answered directly; only the rest share a marshaled prompt.
+        # Each book's single-book prompt and cache key are built once here
+        entries_by_book = {}
+        pending = []  # (book_id, pages, prompt, cache key)
+        for book_id, pages in loaded:
+            prompt_content = self._build_prompt(pages)
+            cache_key = self._cache_key(prompt_content)
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                logger.info(f"Using cached names for book {book_id}")
+                entries_by_book[book_id] = self._tag_entries(book_id, cached)
+            else:
+                pending.append((book_id, pages, prompt_content, cache_key))
+        
+        marshaled = None
+        if len(pending) > 1:
+            marshaled = await self.analyze_books_batched([(book_id, pages, cache_key) for book_id, pages, _, cache_key in pending])
+        
+        if marshaled is None:
+            # Single book, or the marshaled response was invalid: one call per book
+            per_book = await asyncio.gather(*(self.analyze_book_portraits(book_id, prompt_content, cache_key)
+                                              for book_id, _, prompt_content, cache_key in pending))
+            marshaled = {book_id: entries for (book_id, _, _, _), entries in zip(pending, per_book)}
+        entries_by_book.update(marshaled)
+        
+        for book_id, biographical_entries in entries_by_book.items():
+            book_results[book_id] = self._book_result(book_id, biographical_entries)
+        
+        for book_id, book_result in book_results.items():
+            book_results[book_id] = await self._finish_book(book_id, book_result, output_path)
+        
+        return book_results
+    
+    async def _process_books_batch(self, books: Dict[str, List[Path]], output_path: Path) -> Dict[str, Dict]:
+        """Process all books with a single Gemini batch job"""
+        book_results = {}
+        prompts = {}
+        
+        for book_id, page_dirs in books.items():
+            pages = await asyncio.to_thread(self.load_book_content, page_dirs)
+            if not pages:
+                book_results[book_id] = {"book_id": book_id, "error": "No pages loaded"}
+                continue
+            prompts[book_id] = self._build_prompt(pages)
+        
+        # Only prompts without cached entries go into the batch job
+        cache_keys = {book_id: self._cache_key(prompt) for book_id, prompt in prompts.items()}
+        cached_entries = {}
+        for book_id, key in cache_keys.items():
+            cached = self._cache_get(key)
+            if cached is not None:
+                cached_entries[book_id] = self._tag_entries(book_id, cached)
+        pending = {book_id: prompt for book_id, prompt in prompts.items() if book_id not in cached_entries}
+        logger.info(f"{len(cached_entries)} books served from cache, {len(pending)} submitted to batch")
+        
+        # A failed job marks its books failed; cached and unloadable books are still saved
+        responses = {}
+        if pending:
+            try:
+                responses = await self._submit_batch(pending)
+            except Exception as e:
+                logger.error(f"Batch job failed for {len(pending)} books: {e}")
+                for book_id in pending:
+                    self._failed_books[book_id] = f"Batch job failed: {e}"
+        
+        for book_id in prompts:
+            biographical_entries = cached_entries.get(book_id, [])
+            if book_id in responses:
+                try:
+                    biographical_entries = self._parse_entries(book_id, responses[book_id])
+                    self._cache_set(cache_keys[book_id], biographical_entries)
+                except Exception as e:
+                    logger.error(f"Error extracting names for {book_id}: {e}")
+                    self._failed_books[book_id] = str(e) or repr(e)
+            elif book_id in pending:
+                self._failed_books.setdefault(book_id, "No response in batch output")
+            book_results[book_id] = self._book_result(book_id, biographical_entries)
+        
+        for book_id, book_result in book_results.items():
+            book_results[book_id] = await self._finish_book(book_id, book_result, output_path)
+        
+        return book_results
+    
+    async def _process_books_realtime(self, books: Dict[str, List[Path]], output_path: Path, results: Dict):
+        """Process all books concurrently, in chunks that share one prompt"""
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        # Group books into chunks that share one prompt
+        book_items = iter(books.items())
+        chunks = []
+        while chunk := list(islice(book_items, self.books_per_prompt)):
+            chunks.append(chunk)
+        
+        chunk_results = await asyncio.gather(
+            *(self._process_and_save_chunk(chunk, output_path) for chunk in chunks),
+            return_exceptions=True,
+        )
+        
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            if isinstance(chunk_result, Exception):
+                for book_id, _ in chunk:
+                    logger.error(f"Error processing book {book_id}: {chunk_result}")
+                    results["books"][book_id] = {"error": str(chunk_result)}
+            else:
+                results["books"].update(chunk_result)
+    
+    async def process_input(self, input_path: str, output_dir: str, use_batch: bool = True,
+                            output_format: str = "jsonl") -> Dict:
+        """Process input directory containing page directories, as one batch job or all books concurrently"""
         input_path = Path(input_path)
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
@@ -294,6 +663,9 @@ class BookPortraitAssociator:
         if not books:
             return {"error": f"No page directories found in {input_path}"}
         
+        self._failed_books = {}
+        (output_path / "failed").mkdir(exist_ok=True)
+        
         results = {
             "input_path": str(input_path),
             "output_path": str(output_path),
@@ -302,39 +674,58 @@ class BookPortraitAssociator:
             "books": {}
         }
         
-        for book_id, page_dirs in books.items():
-            try:
-                book_result = self.process_book(book_id, page_dirs)
-                results["books"][book_id] = book_result
-                
-                # Save individual book result
-                book_output_file = output_path / f"{book_id}_names.json"
-                with open(book_output_file, 'w', encoding='utf-8') as f:
-                    json.dump(book_result, f, indent=2, ensure_ascii=False)
-                
-                logger.info(f"Found {len(book_result.get('biographical_entries', []))} names in {book_id}")
-                
-            except Exception as e:
-                logger.error(f"Error processing book {book_id}: {e}")
-                results["books"][book_id] = {"error": str(e)}
-        
-        # Save combined results
-        combined_output = output_path / "all_books_names.json"
-        with open(combined_output, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        # JSONL: one line per book as it completes; JSON: one document written at the end
+        if output_format == "jsonl":
+            self._combined_file = open(output_path / "all_books_names.jsonl", 'wb')
+        try:
+            if use_batch:
+                results["books"] = await self._process_books_batch(books, output_path)
+            else:
+                await self._process_books_realtime(books, output_path, results)
+        finally:
+            if self._combined_file is not None:
+                self._combined_file.close()
+                self._combined_file = None
+        
+        if output_format == "json":
+            # Save combined results
+            combined_output = output_path / "all_books_names.json"
+            with open(combined_output, 'wb') as f:
+                f.write(_json_dumps(results, indent=True))
         
         return results
     
 def main():
-    vault = KeyVault()    
-    #api_key = vault.get_key("SDUGeminiAPI")
-    api_key = vault.get_key("AMDGeminiFlashKey")
+    # KeyVault lives in the parent project; only the CLI needs it
+    api_key = None
+    sys.path.append(str(Path(os.getcwd()).parent))
+    try:
+        from agents.key_vault import KeyVault
+        vault = KeyVault()
+        #api_key = vault.get_key("SDUGeminiAPI")
+        api_key = vault.get_key("AMDGeminiFlashKey")
+    except ImportError:
+        logger.warning("agents.key_vault not available, pass --api-key or set AMDGeminiFlashKey")
 
     parser = argparse.ArgumentParser(description="Associate portraits with names in Norwegian biography pages using Google Gemini")
     parser.add_argument("input_path", help="Directory containing page directories")
     parser.add_argument("output_dir", help="Directory to save results")
     parser.add_argument("--api-key", help="Google Gemini API key", 
-                       default=api_key)
+                       default=api_key or os.getenv("AMDGeminiFlashKey"))
+    parser.add_argument("--mode", default="batch", choices=["batch", "realtime"],
+                       help="batch: one Gemini Batch API job (cheaper, slower); realtime: concurrent requests")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS,
+                       help="Maximum number of concurrent Gemini requests")
+    parser.add_argument("--books-per-prompt", type=int, default=BOOKS_PER_PROMPT,
+                       help="Books packed into one prompt in realtime mode")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                       help="Directory for cached Gemini results")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Always call the API and do not cache results")
+    parser.add_argument("--format", dest="output_format", default="jsonl", choices=["jsonl", "json"],
+                       help="Combined output: all_books_names.jsonl streamed per book, or all_books_names.json at the end")
+    parser.add_argument("--prefilter", action=argparse.BooleanOptionalAction, default=True,
+                       help="Send only candidate entry lines (with context) instead of full pages")
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     
     args = parser.parse_args()
@@ -352,13 +743,18 @@ def main():
     
     # Initialize associator
     try:
-        associator = BookPortraitAssociator(api_key=args.api_key)
+        associator = BookPortraitAssociator(api_key=args.api_key, max_concurrency=args.concurrency,
+                                            books_per_prompt=args.books_per_prompt,
+                                            cache_dir=None if args.no_cache else args.cache_dir,
+                                            prefilter=args.prefilter)
         
         logger.info(f"Processing input: {args.input_path}")
         logger.info(f"Using Google Gemini model: {associator.model}")
         
         # Process the input
-        results = associator.process_input(args.input_path, args.output_dir)
+        results = asyncio.run(associator.process_input(args.input_path, args.output_dir,
+                                                       use_batch=args.mode == "batch",
+                                                       output_format=args.output_format))
         
         # Print summary
         if "books" in results:
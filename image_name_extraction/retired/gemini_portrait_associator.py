@@ -6,17 +6,26 @@ with special handling for cross-page biographical entries and robust JSON parsin
 """
 
 import os
-import json
 import re
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import base64
+import ijson
+import orjson
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel, Field, TypeAdapter
 import argparse
 import logging
 import time
-from collections import defaultdict
+import asyncio
+import hashlib
+import io
+import queue
+import random
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 # In Python interactive shell for testing
 import sys
 from pathlib import Path
@@ -27,26 +36,45 @@ from agents.key_vault import KeyVault
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class BookPortraitAssociator:
-    def __init__(self, api_key: str = None):
-        # Google Gemini configuration
-        self.api_key = api_key or os.getenv("SDUGeminiAPI")
-        
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY is required. Set it as environment variable or pass as parameter.")
-        
-        # Initialize Gemini client
-        self.client = genai.Client(api_key=self.api_key)
-        self.model = "gemini-2.5-flash-lite-preview-06-17"
-        
-    # ...existing code... (get_page_number, get_book_id, find_page_directories, load_page_content, load_book_content, extract_json_from_response, fix_json_string methods remain unchanged)
-    
-    def analyze_book_portraits(self, book_id: str, pages: List[Dict]) -> List[Dict]:
-        """Use Google Gemini to analyze figure placeholders and names across all pages with cross-page awareness"""
-        
-        # Prepare the content for LLM analysis with explicit cross-page context
-        prompt_content = f"""You are analyzing a Norwegian biographical reference work that spans multiple pages. 
-The book ID is: {book_id}
+# JSON string literals (escapes included) and the raw control characters to escape inside them
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_STRING_ESCAPES = str.maketrans({'\n': '\\n', '\r': '\\r'})
+
+# Upper bound on Gemini requests in flight at once (keeps us under the RPM limit)
+MAX_CONCURRENT_REQUESTS = 6
+
+# Retry policy for transient Gemini failures (rate limits, overload, timeouts)
+MAX_API_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {429, 500, 503, 504}
+REQUEST_TIMEOUT_SECONDS = 120
+RETRY_MAX_DELAY_SECONDS = 30
+
+# Books are analyzed in overlapping page windows packed up to a token budget;
+# the last page of a window is the first of the next
+WINDOW_MAX_TOKENS = 6000
+WINDOW_OVERLAP = 1
+CHARS_PER_TOKEN = 4  # token estimate when count_tokens is unavailable
+
+# On-disk cache of parsed associations, keyed by a hash of model + prompt
+DEFAULT_CACHE_DIR = "./.llm_cache"
+
+# Thinking budget scales with the work in a window: a base, plus per figure and per input token
+THINKING_BUDGET = 2996
+THINKING_BASE = 200
+THINKING_PER_FIGURE = 50
+THINKING_PER_TOKEN = 0.02
+
+# Prompt condensing: keep lines near a figure tag or a biography heading (ALL-CAPS surname + comma)
+_CONDENSE_ANCHOR_RE = re.compile(r'<figure|^[A-ZÆØÅ]{2,}\s*,')
+CONDENSE_CONTEXT_LINES = 2
+CONDENSE_ELISION = "[…]"
+
+# Portrait placeholders in the OCR markdown; pages without one never need Gemini
+FIGURE_TAG = '<figure'
+
+# Instructions shared by every book and window; stored once as Gemini cached content
+# and followed by the per-book page text in each request
+STATIC_PREAMBLE = """You are analyzing a Norwegian biographical reference work that spans multiple pages. 
 
 IMPORTANT: Biographical entries sometime span across consecutive pages. Common patterns:
 1. A person's name (SURNAME, Given names) appears at the END of page N
@@ -58,29 +86,6 @@ SURNAME, Given names, profession, biographical details...
 
 Figure placeholders appear as <figure></figure> tags in the markdown - these represent portrait locations.
 
-PAGES TO ANALYZE (in sequential order):
-"""
-        
-        for i, page in enumerate(pages):
-            prompt_content += f"""
---- PAGE {page['page_number']} (Directory: {page['page_name']}) ---
-
-Markdown content:
-{page['content']}
-
-"""
-            
-            # Add context about the next page for cross-page analysis
-            if i < len(pages) - 1:
-                next_page = pages[i + 1]
-                # Show first 500 characters of next page to help with cross-page associations
-                next_preview = next_page['content'][:500] + "..." if len(next_page['content']) > 500 else next_page['content']
-                prompt_content += f"""
-[PREVIEW OF NEXT PAGE {next_page['page_number']} - First 500 characters:]
-{next_preview}
-
-"""        
-        prompt_content += """
 TASK:
 Analyze ALL pages together to associate each portrait/image with the person it most likely depicts.
 
@@ -89,7 +94,7 @@ IMPORTANT (strict pairing rules, in priority order):
 2.  **Labelling the portraits** – All portraits are identified by `<figure></figure>`. Please enumerate them by their appearance, such that the figure appearing first is labelled Figure 1, the figure appearing second is labelled Figure 2, etc.
 3.  **Immediate-name rule (highest certainty)** – If the image tag is followed (same line or next non-empty line) by a name whose LASTNAME is in ALL-CAPS, **always pair this image with that name**. Treat this as a 100% match unless another image intervenes. IMPORTANT: If the name is not in ALL-CAPS, do NOT use it for pairing.
 4.  **Paragraph-embedded rule** – If the image tag sits inside a prose paragraph that is clearly describing a person, pair the image with that individual rather than the next standalone name heading.
-5.  **Page-start rule** – If a markdown page *begins* with an image tag, set the `associated_person` to \"unknown\". This rule is overridden by the **Immediate-name rule**; if a name in ALL-CAPS immediately follows the image, use that name instead.
+5.  **Page-start rule** – If a markdown page *begins* with an image tag, set the `associated_person` to "unknown". This rule is overridden by the **Immediate-name rule**; if a name in ALL-CAPS immediately follows the image, use that name instead.
 6.  **Conflict handling** – If two images appear back-to-back with no intervening name, or if one name plausibly maps to multiple images, list all possibilities but set `associated_person` to null and flag for manual review.
 
 CRITICAL: Ensure your response is valid JSON format. Escape all quotes and newlines properly in string values.
@@ -102,17 +107,17 @@ For each image found (both referenced in markdown and available in directories),
 Respond with ONLY a valid JSON array (no other text) and only for those persons that can be associated with a portrait. The JSON should have the following structure:
 [
   {
-    \"Portrait associated\": \"Figure 1\",
-    \"referenced_in_markdown\": true or false,
-    \"associated_person\": \"SURNAME, Given Names\",
-    \"portrait_page\": page_number,
-    \"person_page\": page_number,
-    \"person_directory\": \"page_directory_name\",
-    \"confidence\": 0.92,
-    \"is_cross_page\": true or false,
-    \"cross_page_type\": \"same_page\",
-    \"reasoning\": \"Brief explanation without quotes or newlines\",
-    \"context_evidence\": \"Relevant text snippet without quotes or newlines\"
+    "Portrait associated": "Figure 1",
+    "referenced_in_markdown": true or false,
+    "associated_person": "SURNAME, Given Names",
+    "portrait_page": page_number,
+    "person_page": page_number,
+    "person_directory": "page_directory_name",
+    "confidence": 0.92,
+    "is_cross_page": true or false,
+    "cross_page_type": "same_page",
+    "reasoning": "Brief explanation without quotes or newlines",
+    "context_evidence": "Relevant text snippet without quotes or newlines"
   }
 ]
 
@@ -123,68 +128,431 @@ IMPORTANT (output hygiene):
 - Keep reasoning and context_evidence brief and on single lines
 - If no association can be made, set `associated_person` to null
 """
+PREAMBLE_CACHE_TTL_SECONDS = 3600
+PREAMBLE_CACHE_REFRESH_SECONDS = 600  # extend the TTL once less than this is left
+
+# Gemini Batch API polling
+BATCH_TERMINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_POLL_MIN_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+
+# Raw responses are saved here when running with --log-level DEBUG
+DEBUG_DIR = Path("debug_responses")
+
+class Assoc(BaseModel):
+    """One portrait-to-person association, as Gemini is constrained to return it"""
+    portrait_associated: str = Field(alias="Portrait associated")
+    referenced_in_markdown: bool
+    associated_person: Optional[str]
+    portrait_page: int
+    person_page: int
+    person_directory: str
+    confidence: float
+    is_cross_page: bool
+    cross_page_type: str
+    reasoning: str
+    context_evidence: str
+
+# JSON Schema for batch request lines, which carry the schema as plain JSON
+ASSOC_LIST_JSON_SCHEMA = TypeAdapter(List[Assoc]).json_schema(by_alias=True)
+
+# Directory probes and markdown reads are I/O bound (often network storage), so oversubscribe the CPUs
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+class BookPortraitAssociator:
+    def __init__(self, api_key: str = None, max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                 cache_dir: Optional[str] = DEFAULT_CACHE_DIR, condense: bool = True,
+                 max_thinking: int = THINKING_BUDGET, repair_json: bool = False):
+        # Google Gemini configuration
+        self.api_key = api_key or os.getenv("SDUGeminiAPI")
+        
+        if not self.api_key:
+            raise ValueError("GEMINI_API_KEY is required. Set it as environment variable or pass as parameter.")
+        
+        # Initialize Gemini client
+        self.client = genai.Client(api_key=self.api_key)
+        self.model = "gemini-2.5-flash-lite-preview-06-17"
+        self.max_concurrency = max_concurrency
+        self.condense = condense
+        self.max_thinking = max_thinking
+        self.repair_json = repair_json  # regex/bracket-scan recovery for responses that break the schema
+        self._semaphore = None  # created inside the running event loop
+        self._failed_books = {}  # book_id -> error for books with a window whose request ultimately failed
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)  # shared by scans and page reads
+        
+        # Result files are written by one background thread so serialization I/O never delays the next request
+        self._write_queue = queue.Queue()
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+        
+        # The static instructions are uploaded as cached content for realtime runs only
+        self._preamble_cache = None
+        self._preamble_cache_expiry = 0.0
+        self._preamble_cache_lock = None  # created inside the running event loop
+        
+        # Parsed associations are cached on disk; None disables the cache
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+    def _cache_key(self, prompt_content: str) -> str:
+        """Cache key for a prompt sent to the current model; any change to pages or instructions invalidates it"""
+        return hashlib.blake2b(f"{self.model}|{STATIC_PREAMBLE}|".encode('utf-8') + prompt_content.encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[List[Dict]]:
+        """Return cached associations, or None on a miss or when caching is disabled"""
+        if not self.cache_dir:
+            return None
         try:
-            # Prepare content for Gemini
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt_content),
-                    ],
-                ),
-            ]
+            with open(self.cache_dir / f"{key}.json", 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return None
+    
+    def _cache_set(self, key: str, associations: List[Dict]):
+        """Store associations; written to a temp file first so readers never see a partial entry"""
+        if not self.cache_dir:
+            return
+        cache_file = self.cache_dir / f"{key}.json"
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(associations))
+        os.replace(tmp_file, cache_file)
+    
+    # ...existing code... (get_page_number, get_book_id, find_page_directories, load_page_content, load_book_content, extract_json_from_response, fix_json_string methods remain unchanged)
+    
+    def _condense(self, content: str) -> str:
+        """Keep only lines within CONDENSE_CONTEXT_LINES of a figure tag or surname heading, marking elisions"""
+        lines = content.splitlines()
+        keep = [False] * len(lines)
+        for i, line in enumerate(lines):
+            if _CONDENSE_ANCHOR_RE.search(line):
+                for j in range(max(0, i - CONDENSE_CONTEXT_LINES), min(len(lines), i + CONDENSE_CONTEXT_LINES + 1)):
+                    keep[j] = True
+        
+        relevant_lines = []
+        for line, kept in zip(lines, keep):
+            if kept:
+                relevant_lines.append(line)
+            elif not relevant_lines or relevant_lines[-1] != CONDENSE_ELISION:
+                relevant_lines.append(CONDENSE_ELISION)
+        return "\n".join(relevant_lines)
+    
+    def _build_prompt(self, book_id: str, pages: List[Dict], next_page: Optional[Dict] = None) -> str:
+        """Build the association prompt for a run of pages, with a preview of the page that follows"""
+        
+        # Per-book text only; the instructions live in STATIC_PREAMBLE
+        parts = [f"""The book ID is: {book_id}
+
+PAGES TO ANALYZE (in sequential order):
+"""]
+        
+        for i, page in enumerate(pages):
+            parts.append(f"""
+--- PAGE {page['page_number']} (Directory: {page['page_name']}) ---
+
+Markdown content:
+{self._condense(page['content']) if self.condense else page['content']}
+
+""")
             
-            # Configure generation
-            generate_content_config = types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=2996,
+            # Add context about the next page for cross-page analysis (the page after the window for the last page)
+            # Skipped when neither page has a figure, since nothing can pair across them
+            following = pages[i + 1] if i < len(pages) - 1 else next_page
+            if following is not None and (page['figure_count'] or following['figure_count']):
+                # Show first 500 characters of next page to help with cross-page associations
+                next_preview = following['content'][:500] + "..." if len(following['content']) > 500 else following['content']
+                parts.append(f"""
+[PREVIEW OF NEXT PAGE {following['page_number']} - First 500 characters:]
+{next_preview}
+
+""")
+        
+        return "".join(parts)
+    
+    def _thinking_budget(self, pages: List[Dict]) -> int:
+        """Thinking budget for a window, from its figure count and input tokens, capped at max_thinking"""
+        n_fig = sum(p['figure_count'] for p in pages)
+        n_tok = sum(self._page_tokens(p) for p in pages)
+        return int(min(self.max_thinking, THINKING_BASE + THINKING_PER_FIGURE * n_fig + THINKING_PER_TOKEN * n_tok))
+    
+    async def _open_preamble_cache(self):
+        """Upload STATIC_PREAMBLE as cached content; falls back to inlining it when the
+        model or the preamble size does not allow context caching"""
+        try:
+            self._preamble_cache = await self.client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    contents=[types.Content(role="user", parts=[types.Part.from_text(text=STATIC_PREAMBLE)])],
+                    ttl=f"{PREAMBLE_CACHE_TTL_SECONDS}s",
                 ),
-                response_mime_type="application/json",
             )
+            self._preamble_cache_expiry = time.monotonic() + PREAMBLE_CACHE_TTL_SECONDS
+            logger.info(f"Cached prompt preamble as {self._preamble_cache.name}")
+        except errors.APIError as e:
+            logger.warning(f"Context caching unavailable, sending the preamble inline: {e}")
+            self._preamble_cache = None
+    
+    async def _preamble_cache_name(self) -> Optional[str]:
+        """Name of the live preamble cache (None to inline the preamble), extending its TTL before it expires"""
+        if self._preamble_cache is None:
+            return None
+        async with self._preamble_cache_lock:
+            if self._preamble_cache is not None and time.monotonic() > self._preamble_cache_expiry - PREAMBLE_CACHE_REFRESH_SECONDS:
+                try:
+                    await self.client.aio.caches.update(
+                        name=self._preamble_cache.name,
+                        config=types.UpdateCachedContentConfig(ttl=f"{PREAMBLE_CACHE_TTL_SECONDS}s"),
+                    )
+                    self._preamble_cache_expiry = time.monotonic() + PREAMBLE_CACHE_TTL_SECONDS
+                except errors.APIError as e:
+                    logger.warning(f"Could not extend preamble cache {self._preamble_cache.name}, recreating it: {e}")
+                    await self._open_preamble_cache()
+        return self._preamble_cache.name if self._preamble_cache else None
+    
+    async def _replace_preamble_cache(self, stale_name: str):
+        """Recreate the preamble cache after a request found it gone; concurrent callers recreate it once"""
+        async with self._preamble_cache_lock:
+            if self._preamble_cache is not None and self._preamble_cache.name == stale_name:
+                await self._open_preamble_cache()
+    
+    async def _close_preamble_cache(self):
+        """Delete the preamble cache so it stops accruing storage cost"""
+        if self._preamble_cache is None:
+            return
+        try:
+            await self.client.aio.caches.delete(name=self._preamble_cache.name)
+        except errors.APIError as e:
+            logger.warning(f"Could not delete preamble cache {self._preamble_cache.name}: {e}")
+        self._preamble_cache = None
+    
+    def _tag_and_cache(self, book_id: str, cache_key: str, associations: List[Dict]) -> List[Dict]:
+        """Add the book ID to each association and store the list in the cache"""
+        for assoc in associations:
+            assoc["book_id"] = book_id
+        self._cache_set(cache_key, associations)
+        return associations
+    
+    def _parse_response_text(self, response_text: str) -> List[Dict]:
+        """Parse a complete (non-streamed) response, falling back to tolerant extraction when repair is enabled"""
+        try:
+            data = orjson.loads(response_text)
+            if isinstance(data, list):
+                return data
+        except orjson.JSONDecodeError:
+            pass
+        if self.repair_json:
+            data = self.extract_json_from_response(response_text)
+            if data:
+                return data
+        raise ValueError("Response is not a JSON array")
+    
+    async def _stream_response(self, contents: List[types.Content],
+                               config: types.GenerateContentConfig) -> Tuple[str, Optional[List[Dict]]]:
+        """Stream one response, parsing each array item as soon as it completes; associations are None if the JSON is invalid"""
+        parsed = ijson.sendable_list()
+        parser = ijson.items_coro(parsed, 'item', use_float=True)
+        associations = []
+        chunks = []  # raw text, kept for the debug output
+        async for chunk in await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=contents,
+            config=config,
+        ):
+            # Chunks without a text part (e.g. thought-only or final metadata chunks) have text None
+            text = chunk.text or ""
+            if not text:
+                continue
+            chunks.append(text)
+            if associations is None:
+                continue
+            try:
+                parser.send(text.encode('utf-8'))
+                associations.extend(parsed)
+                del parsed[:]
+            except ijson.JSONError:
+                associations = None
+        if associations is not None:
+            try:
+                parser.close()
+                associations.extend(parsed)
+            except ijson.JSONError:
+                associations = None
+        return "".join(chunks), associations
+    
+    async def _call_gemini(self, contents: List[types.Content],
+                           config: types.GenerateContentConfig) -> Tuple[str, Optional[List[Dict]]]:
+        """Stream a Gemini response, retrying transient errors with jittered exponential backoff"""
+        # The semaphore caps concurrent requests; backoff sleeps happen outside it
+        for attempt in range(MAX_API_ATTEMPTS):
+            try:
+                async with self._semaphore:
+                    return await asyncio.wait_for(self._stream_response(contents, config), timeout=REQUEST_TIMEOUT_SECONDS)
+            except (errors.APIError, asyncio.TimeoutError) as e:
+                if isinstance(e, errors.APIError) and e.code not in RETRYABLE_STATUS_CODES:
+                    raise
+                if attempt == MAX_API_ATTEMPTS - 1:
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, 2 ** (attempt + 1)))
+                logger.warning(f"Gemini request failed ({e!r}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_API_ATTEMPTS})")
+                await asyncio.sleep(delay)
+    
+    async def analyze_book_portraits(self, book_id: str, pages: List[Dict], next_page: Optional[Dict] = None) -> List[Dict]:
+        """Use Google Gemini to analyze figure placeholders and names across all pages with cross-page awareness"""
+        prompt_content = self._build_prompt(book_id, pages, next_page)
+        
+        cache_key = self._cache_key(prompt_content)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"Using cached associations for book {book_id} (pages {pages[0]['page_number']}-{pages[-1]['page_number']})")
+            return cached
+        
+        try:
+            for attempt in range(2):
+                # Prepare content for Gemini; the preamble comes from the context cache when available
+                cache_name = await self._preamble_cache_name()
+                parts = [types.Part.from_text(text=prompt_content)]
+                if cache_name is None:
+                    parts.insert(0, types.Part.from_text(text=STATIC_PREAMBLE))
+                contents = [
+                    types.Content(
+                        role="user",
+                        parts=parts,
+                    ),
+                ]
+                
+                # Configure generation
+                generate_content_config = types.GenerateContentConfig(
+                    thinking_config=types.ThinkingConfig(
+                        thinking_budget=self._thinking_budget(pages),
+                    ),
+                    response_mime_type="application/json",
+                    response_schema=List[Assoc],
+                    cached_content=cache_name,
+                )
+                
+                try:
+                    response_text, associations = await self._call_gemini(contents, generate_content_config)
+                    break
+                except errors.APIError as e:
+                    # An expired or deleted cache is reported as NOT_FOUND or PERMISSION_DENIED; recreate it and retry once
+                    if cache_name is None or e.code not in (403, 404) or attempt:
+                        raise
+                    logger.warning(f"Preamble cache {cache_name} unavailable for book {book_id}, recreating it: {e}")
+                    await self._replace_preamble_cache(cache_name)
+            if logger.isEnabledFor(logging.DEBUG):
+                print("Response received!",response_text)
+                logger.debug(f"Raw Gemini Response for {book_id}: {response_text[:500]}...")
+                
+                # Save raw response for debugging, one file per window so concurrent requests don't clobber each other
+                DEBUG_DIR.mkdir(parents=True, exist_ok=True)
+                debug_file = DEBUG_DIR / f"{book_id}_{pages[0]['page_number']}.txt"
+                self._write_queue.put((debug_file, f"Book: {book_id}\nResponse:\n{response_text}\n".encode('utf-8')))
             
-            # Generate response using streaming
-            response_text = ""
-            for chunk in self.client.models.generate_content_stream(
-                model=self.model,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                response_text += chunk.text
-            print("Response received!",response_text)
-            logger.debug(f"Raw Gemini Response for {book_id}: {response_text[:500]}...")
-            
-            # Save raw response for debugging
-            debug_file = Path("debug_response.txt")
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(f"Book: {book_id}\n")
-                f.write(f"Response:\n{response_text}\n")
-            
-            # Parse JSON response directly
-            associations = json.loads(response_text)
+            if associations is None and self.repair_json:
+                logger.warning(f"Invalid JSON for book {book_id}, attempting repair")
+                # An empty extraction means the repair failed, not that there are no associations
+                associations = self.extract_json_from_response(response_text) or None
+            if associations is None:
+                logger.error(f"JSON decode error for book {book_id} (pages {pages[0]['page_number']}-{pages[-1]['page_number']})")
+                self._failed_books[book_id] = f"Invalid JSON for pages {pages[0]['page_number']}-{pages[-1]['page_number']}"
+                return []
             
-            if associations and isinstance(associations, list):
-                # Add book ID to each association
-                for assoc in associations:
-                    assoc["book_id"] = book_id
-                
+            # Only parsed responses are cached, so failed windows are asked again next run
+            self._tag_and_cache(book_id, cache_key, associations)
+            if associations:
                 logger.info(f"Successfully extracted {len(associations)} associations")
-                return associations
             else:
                 logger.warning(f"No valid associations in response for {book_id}")
+            return associations
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error for book {book_id}: {e}")
         except Exception as e:
             logger.error(f"Error in Gemini analysis for book {book_id}: {e}")
+            self._failed_books[book_id] = str(e) or repr(e)
+        
+        return []
+    
+    def _page_prompt_text(self, page: Dict) -> str:
+        """A page's text as it appears in the prompt"""
+        return self._condense(page['content']) if self.condense else page['content']
+    
+    def _page_tokens(self, page: Dict) -> int:
+        """Input tokens for a page: the count from _count_page_tokens, or a local estimate (no API call)"""
+        if 'token_count' not in page:
+            page['token_count'] = len(self._page_prompt_text(page)) // CHARS_PER_TOKEN
+        return page['token_count']
+    
+    def _count_page_tokens(self, pages: List[Dict]):
+        """Set token_count on each page from one count_tokens call over all of them, split by each page's
+        share of the characters; blocking, so call it off the event loop"""
+        todo = [p for p in pages if 'token_count' not in p]
+        if not todo:
+            return
+        texts = [self._page_prompt_text(p) for p in todo]
+        n_chars = sum(len(text) for text in texts)
+        try:
+            total = self.client.models.count_tokens(model=self.model, contents="".join(texts)).total_tokens
+            tokens_per_char = total / n_chars if n_chars else 0
+        except Exception as e:
+            logger.warning(f"count_tokens failed for {len(todo)} pages, estimating: {e}")
+            tokens_per_char = 1 / CHARS_PER_TOKEN
+        for page, text in zip(todo, texts):
+            page['token_count'] = round(len(text) * tokens_per_char)
+    
+    def _pack_by_tokens(self, pages: List[Dict], max_tokens: int = WINDOW_MAX_TOKENS,
+                        overlap: int = WINDOW_OVERLAP) -> List[Tuple[List[Dict], Optional[Dict]]]:
+        """Greedily pack pages into overlapping windows of at most max_tokens, each with the page that follows it"""
+        self._count_page_tokens(pages)
         
+        windows = []
+        start = 0
+        prev_end = 0
+        while True:
+            # Every window takes at least one page the previous window did not have, even if it overflows
+            end = start
+            total = 0
+            while end < len(pages) and (end <= prev_end or total + pages[end]['token_count'] <= max_tokens):
+                total += pages[end]['token_count']
+                end += 1
+            windows.append((pages[start:end], pages[end] if end < len(pages) else None))
+            if end == len(pages):
+                return windows
+            prev_end = end
+            start = max(start + 1, end - overlap)
+    
+    def _merge_window_associations(self, windows: List[Tuple[List[Dict], Optional[Dict]]],
+                                   window_results: List[List[Dict]]) -> List[Dict]:
+        """Combine per-window associations, dropping duplicates from shared pages and renumbering figures"""
+        merged = []
+        prev_pages = set()
+        for (window, _), associations in zip(windows, window_results):
+            # A shared page belongs to the earlier window, which also holds the page before it
+            # (names at the end of page N, portrait at the start of page N+1)
+            page_numbers = {p['page_number'] for p in window}
+            shared_pages = page_numbers & prev_pages
+            prev_pages = page_numbers
+            for assoc in associations:
+                if assoc.get("portrait_page") not in shared_pages:
+                    merged.append(assoc)
+        
+        # Windows are in page order and figures within a window in appearance order
+        for n, assoc in enumerate(merged, start=1):
+            assoc["Portrait associated"] = f"Figure {n}"
+        return merged
+    
+    def _has_figures(self, pages: List[Dict]) -> bool:
+        """Whether any of the pages contains a figure placeholder"""
+        return any(p['figure_count'] for p in pages)
+    
+    async def _no_associations(self) -> List[Dict]:
+        """Stand-in result for windows that are not sent to Gemini"""
         return []
     
-    def process_book(self, book_id: str, page_dirs: List[Path]) -> Dict:
+    async def process_book(self, book_id: str, page_dirs: List[Tuple[Path, Path]]) -> Dict:
         """Process a single book with cross-page awareness - analyze figure placeholders"""
         logger.info(f"Processing book: {book_id}")
         
-        # Load all pages
-        pages = self.load_book_content(page_dirs)
+        # Load all pages; file reads run in a worker thread so the event loop stays free
+        pages = await asyncio.to_thread(self.load_book_content, page_dirs)
         
         if not pages:
             return {
@@ -193,18 +561,40 @@ IMPORTANT (output hygiene):
                 "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
             }
         
-        # Always analyze with Gemini - let Gemini find figure placeholders
-        logger.info(f"Analyzing {len(pages)} pages to associate figure placeholders with names")
+        # Books without figure placeholders have nothing to associate
+        n_fig = sum(p['figure_count'] for p in pages)
+        if n_fig == 0:
+            logger.info(f"Book {book_id}: no figure placeholders in {len(pages)} pages, skipping Gemini")
+            return self._build_book_result(book_id, pages, [])
+        
+        logger.info(f"Analyzing {len(pages)} pages to associate {n_fig} figure placeholders with names")
+        
+        # Analyze overlapping page windows concurrently (only those containing figures), then merge them back into one book
+        windows = await asyncio.to_thread(self._pack_by_tokens, pages)
+        window_results = await asyncio.gather(
+            *(self.analyze_book_portraits(book_id, window, next_page) if self._has_figures(window) else self._no_associations()
+              for window, next_page in windows)
+        )
+        associations = self._merge_window_associations(windows, window_results)
         
-        # Analyze portraits across all pages
-        associations = self.analyze_book_portraits(book_id, pages)
+        return self._build_book_result(book_id, pages, associations)
+    
+    def _build_book_result(self, book_id: str, pages: List[Dict], associations: List[Dict]) -> Dict:
+        """Compile a book's associations into the result record with cross-page statistics"""
+        # Compile results with cross-page statistics, counted in a single pass
+        type_counts = Counter()
+        n_cross_page = n_confident = n_named = 0
+        for a in associations:
+            type_counts[a.get("cross_page_type")] += 1
+            n_cross_page += bool(a.get("is_cross_page", False))
+            n_confident += a.get("confidence", 0) > 0.6
+            n_named += bool(a.get("associated_person"))
         
-        # Compile results with cross-page statistics
         cross_page_stats = {
-            "total_cross_page": len([a for a in associations if a.get("is_cross_page", False)]),
-            "name_previous_page": len([a for a in associations if a.get("cross_page_type") == "name_previous_page"]),
-            "continuation_entries": len([a for a in associations if a.get("cross_page_type") == "continuation"]),
-            "same_page_entries": len([a for a in associations if a.get("cross_page_type") == "same_page"])
+            "total_cross_page": n_cross_page,
+            "name_previous_page": type_counts["name_previous_page"],
+            "continuation_entries": type_counts["continuation"],
+            "same_page_entries": type_counts["same_page"]
         }
         
         result = {
@@ -216,11 +606,11 @@ IMPORTANT (output hygiene):
             "associations": associations,
             "summary": {
                 "total_associations": len(associations),
-                "confident_associations": len([a for a in associations if a.get("confidence", 0) > 0.6]),
-                "cross_page_associations": cross_page_stats["total_cross_page"],
+                "confident_associations": n_confident,
+                "cross_page_associations": n_cross_page,
                 "cross_page_breakdown": cross_page_stats,
-                "unassociated_figures": len([a for a in associations if not a.get("associated_person")]),
-                "success_rate": f"{(len([a for a in associations if a.get('associated_person')])/len(associations)*100):.1f}%" if associations else "0%"
+                "unassociated_figures": len(associations) - n_named,
+                "success_rate": f"{(n_named/len(associations)*100):.1f}%" if associations else "0%"
             },
             "processing_info": {
                 "model_used": self.model,
@@ -231,6 +621,9 @@ IMPORTANT (output hygiene):
             }
         }
         
+        if book_id in self._failed_books:
+            result["error"] = self._failed_books[book_id]
+        
         logger.info(f"Book {book_id}: {len(associations)} figure associations found ({cross_page_stats['total_cross_page']} cross-page)")
         return result
     
@@ -246,31 +639,37 @@ IMPORTANT (output hygiene):
             return '_'.join(parts[:-1])  # Everything except the last part (page number)
         return page_dir_name
     
-    def find_page_directories(self, input_path: Path) -> Dict[str, List[Path]]:
-        """Find all page directories and group by book ID"""
+    def _find_md_file(self, page_dir: Path) -> Optional[Path]:
+        """Resolve the page's markdown file from one directory listing instead of a stat per candidate"""
+        with os.scandir(page_dir) as it:
+            names = {entry.name for entry in it if entry.is_file()}
+        
+        # Original pattern first, then the Azure OCR pattern
+        for candidate in (f"{page_dir.name}.md", f"{page_dir.name}_azure.md"):
+            if candidate in names:
+                return page_dir / candidate
+        return None
+    
+    def find_page_directories(self, input_path: Path) -> Dict[str, List[Tuple[Path, Path]]]:
+        """Find all page directories and group by book ID, as (page directory, markdown file) pairs"""
         books = defaultdict(list)
         
         logger.info(f"Scanning directory: {input_path}")
         
-        # Look for page directories directly under input path
-        for item in input_path.iterdir():
-            if item.is_dir():
-                # Check different markdown file patterns
-                possible_md_files = [
-                    item / f"{item.name}.md",           # Original pattern
-                    item / f"{item.name}_azure.md",    # Azure OCR pattern
-                ]
-                
-                md_file_found = any(md_file.exists() for md_file in possible_md_files)
-                
-                if md_file_found:
-                    book_id = self.get_book_id(item.name)
-                    books[book_id].append(item)
-                    logger.debug(f"Found page directory: {item.name} -> book: {book_id}")
+        # Look for page directories directly under input path; DirEntry caches the file type
+        with os.scandir(input_path) as it:
+            page_dirs = [Path(entry.path) for entry in it if entry.is_dir(follow_symlinks=False)]
+        
+        # Probe the page directories in parallel
+        for item, md_file in zip(page_dirs, self._io_pool.map(self._find_md_file, page_dirs)):
+            if md_file is not None:
+                book_id = self.get_book_id(item.name)
+                books[book_id].append((item, md_file))
+                logger.debug(f"Found page directory: {item.name} -> book: {book_id}")
         
         # Sort pages by page number within each book
         for book_id in books:
-            books[book_id].sort(key=lambda x: self.get_page_number(x.name))
+            books[book_id].sort(key=lambda x: self.get_page_number(x[0].name))
         
         logger.info(f"Found {len(books)} books with total {sum(len(pages) for pages in books.values())} pages")
         for book_id, pages in books.items():
@@ -278,36 +677,28 @@ IMPORTANT (output hygiene):
         
         return books
 
-    def load_page_content(self, page_dir: Path) -> Optional[Dict]:
+    def load_page_content(self, page_dir: Path, md_file: Optional[Path] = None) -> Optional[Dict]:
         """Load content from a single page directory - markdown only"""
         page_name = page_dir.name
         
-        # Try different markdown file naming patterns
-        possible_md_files = [
-            page_dir / f"{page_name}.md",           # Original pattern
-            page_dir / f"{page_name}_azure.md",    # Azure OCR pattern
-        ]
-        
-        md_file = None
-        for possible_file in possible_md_files:
-            if possible_file.exists():
-                md_file = possible_file
-                break
+        # The scan already resolved the markdown file; only probe when called directly
+        if md_file is None:
+            md_file = self._find_md_file(page_dir)
         
         if not md_file:
-            logger.warning(f"Markdown file not found. Tried: {[str(f) for f in possible_md_files]}")
+            logger.warning(f"Markdown file not found. Tried: {page_name}.md, {page_name}_azure.md in {page_dir}")
             return None
         
         try:
-            with open(md_file, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = md_file.read_bytes().decode('utf-8')
             
             page_info = {
                 "page_directory": str(page_dir),
                 "page_name": page_name,
                 "page_number": self.get_page_number(page_name),
                 "md_file": str(md_file),
-                "content": content
+                "content": content,
+                "figure_count": content.count(FIGURE_TAG)
             }
             
             return page_info
@@ -316,54 +707,61 @@ IMPORTANT (output hygiene):
             logger.error(f"Error loading page {page_dir}: {e}")
             return None
     
-    def load_book_content(self, page_dirs: List[Path]) -> List[Dict]:
+    def load_book_content(self, page_dirs: List[Tuple[Path, Path]]) -> List[Dict]:
         """Load content from all pages in the book"""
-        pages = []
-        
         logger.info(f"Loading content from {len(page_dirs)} pages")
         
-        for page_dir in page_dirs:
-            page_info = self.load_page_content(page_dir)
-            if page_info:
-                pages.append(page_info)
+        # map keeps page order; load_page_content handles its own errors
+        page_infos = self._io_pool.map(lambda entry: self.load_page_content(*entry), page_dirs)
+        return [page_info for page_info in page_infos if page_info]
+    
+    def _scan_json_array(self, text: str) -> Optional[str]:
+        """Return the first balanced JSON array in text using a linear bracket-depth scan"""
+        start = text.find('[')
+        if start == -1:
+            return None
+        
+        depth = 0
+        in_str = False
+        esc = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == '\\':
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = True
+            elif ch == '[':
+                depth += 1
+            elif ch == ']':
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
         
-        return pages
+        return None
     
     def extract_json_from_response(self, response_text: str) -> List[Dict]:
         """Robust JSON extraction from LLM response"""
-        # Try to find JSON array in the response
-        json_patterns = [
-            r'\[(?:[^[\]]*|\[[^\]]*\])*\]',  # Match nested JSON arrays
-            r'```json\s*(\[.*?\])\s*```',    # JSON in code blocks
-            r'```\s*(\[.*?\])\s*```',        # JSON in generic code blocks
-        ]
-        
-        for pattern in json_patterns:
-            matches = re.findall(pattern, response_text, re.DOTALL)
-            for match in matches:
-                try:
-                    # Clean up the JSON string
-                    json_str = match.strip()
-                    
-                    # Try to parse it
-                    data = json.loads(json_str)
-                    if isinstance(data, list):
-                        return data
-                except json.JSONDecodeError as e:
-                    logger.debug(f"JSON parse error with pattern {pattern}: {e}")
-                    continue
-        
-        # If no JSON found, try to extract and fix common issues
-        # Look for array-like structures
-        array_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-        if array_match:
-            json_str = array_match.group()
-            
+        # Fast path: the response is already a plain JSON array
+        try:
+            data = orjson.loads(response_text)
+            if isinstance(data, list):
+                return data
+        except orjson.JSONDecodeError:
+            pass
+        
+        # Find the first top-level array (fenced or bare) without a backtracking regex
+        json_str = self._scan_json_array(response_text)
+        if json_str:
             # Try to fix common JSON issues
             try:
                 # Replace problematic characters in strings
                 fixed_json = self.fix_json_string(json_str)
-                data = json.loads(fixed_json)
+                data = orjson.loads(fixed_json)
                 if isinstance(data, list):
                     return data
             except Exception as e:
@@ -373,33 +771,186 @@ IMPORTANT (output hygiene):
         return []
     
     def fix_json_string(self, json_str: str) -> str:
-        """Attempt to fix common JSON formatting issues"""
-        # This is a basic approach - for production, consider using a more robust JSON parser
-        
-        # Save the original for debugging
-        original = json_str
-        
+        """Attempt to fix common JSON formatting issues (raw newlines inside string values)"""
+        # Valid JSON needs no fixing; orjson rejects bad input quickly
         try:
-            # First, try to identify string values and escape quotes within them
-            # This is a simplified approach
-            
-            # Replace newlines within strings with \\n
-            json_str = re.sub(r'(?<=: ")(.*?)(?=")', lambda m: m.group(1).replace('\n', '\\n').replace('\r', '\\r'), json_str)
-            
-            # Replace unescaped quotes within string values (basic approach)
-            # This is very basic and may not work for all cases
-            
+            orjson.loads(json_str)
             return json_str
-            
-        except Exception as e:
-            logger.debug(f"JSON fixing failed: {e}")
-            return original
+        except orjson.JSONDecodeError:
+            pass
+        
+        # Escape newlines inside each string literal with one C-level translate per literal
+        parts = []
+        pos = 0
+        for match in _JSON_STRING_RE.finditer(json_str):
+            parts.append(json_str[pos:match.start()])
+            parts.append(match.group().translate(_STRING_ESCAPES))
+            pos = match.end()
+        parts.append(json_str[pos:])
+        return "".join(parts)
 
-    def process_input(self, input_path: str, output_dir: str) -> Dict:
-        """Process input directory containing page directories"""
+    def _writer_loop(self):
+        """Background writer: persist queued (path, bytes) items; a None payload removes the file"""
+        while True:
+            path, payload = self._write_queue.get()
+            try:
+                if payload is None:
+                    path.unlink(missing_ok=True)
+                else:
+                    path.write_bytes(payload)
+            except Exception as e:
+                logger.error(f"Error writing {path}: {e}")
+            finally:
+                self._write_queue.task_done()
+    
+    async def _process_and_save_book(self, book_id: str, page_dirs: List[Tuple[Path, Path]], output_path: Path) -> Dict:
+        """Process one book and save its result file"""
+        book_result = await self.process_book(book_id, page_dirs)
+        self._queue_book_result(output_path, book_id, book_result)
+        return book_result
+    
+    def _queue_book_result(self, output_path: Path, book_id: str, book_result: Dict):
+        """Queue a book's result file, plus a failed/ marker for failed books (cleared on success)"""
+        book_output_file = output_path / f"{book_id}_portrait_associations.json"
+        self._write_queue.put((book_output_file, orjson.dumps(book_result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)))
+        
+        # Failed books also get a marker in failed/, so a rerun can target just those
+        failed_file = output_path / "failed" / f"{book_id}.json"
+        if "error" in book_result:
+            self._write_queue.put((failed_file, orjson.dumps({"book_id": book_id, "error": book_result["error"]})))
+        else:
+            self._write_queue.put((failed_file, None))
+        
+        logger.info(f"Queued results for {book_id} to {book_output_file}")
+    
+    def _submit_batch(self, prompts: Dict[str, str], thinking_budgets: Dict[str, int]) -> Dict[str, str]:
+        """Run prompts through the Gemini Batch API (JSONL file) and return response text per request key"""
+        # One JSONL line per prompt, keyed so results can be matched back to book windows
+        lines = []
+        for key, prompt_content in prompts.items():
+            lines.append(orjson.dumps({
+                "key": key,
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": STATIC_PREAMBLE}, {"text": prompt_content}]}],
+                    "generation_config": {
+                        "response_mime_type": "application/json",
+                        "response_json_schema": ASSOC_LIST_JSON_SCHEMA,
+                        "thinking_config": {"thinking_budget": thinking_budgets[key]},
+                    },
+                },
+            }))
+        
+        batch_file = self.client.files.upload(
+            file=io.BytesIO(b"\n".join(lines)),
+            config=types.UploadFileConfig(display_name="portrait-associations", mime_type="jsonl"),
+        )
+        batch_job = self.client.batches.create(
+            model=self.model,
+            src=batch_file.name,
+            config={"display_name": "portrait-associations"},
+        )
+        logger.info(f"Submitted batch {batch_job.name} with {len(prompts)} requests")
+        
+        # Poll with exponential backoff until the job reaches a terminal state
+        delay = BATCH_POLL_MIN_SECONDS
+        while batch_job.state.name not in BATCH_TERMINAL_STATES:
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            batch_job = self.client.batches.get(name=batch_job.name)
+            logger.info(f"Batch {batch_job.name} state: {batch_job.state.name}")
+        
+        if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch {batch_job.name} ended with state: {batch_job.state.name}")
+        
+        responses = {}
+        output = self.client.files.download(file=batch_job.dest.file_name)
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            key = item.get("key")
+            response = item.get("response")
+            if not response or not response.get("candidates"):
+                logger.error(f"Batch request failed for {key}: {item.get('error') or response}")
+                continue
+            parts = response["candidates"][0].get("content", {}).get("parts", [])
+            responses[key] = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+        
+        return responses
+    
+    async def _process_books_batch(self, books: Dict[str, List[Tuple[Path, Path]]], output_path: Path) -> Dict[str, Dict]:
+        """Process all books' page windows as one Gemini batch job"""
+        book_results = {}
+        book_windows = {}
+        prompts = {}
+        thinking_budgets = {}
+        
+        for book_id, page_dirs in books.items():
+            pages = await asyncio.to_thread(self.load_book_content, page_dirs)
+            if not pages:
+                book_results[book_id] = {
+                    "book_id": book_id,
+                    "error": "No pages could be loaded",
+                    "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+                }
+                continue
+            # Books without figures are never sent, so their pages need no token counts
+            windows = await asyncio.to_thread(self._pack_by_tokens, pages) if self._has_figures(pages) else [(pages, None)]
+            book_windows[book_id] = (pages, windows)
+            for n, (window, next_page) in enumerate(windows):
+                # Windows without figure placeholders stay out of the batch and merge as empty
+                if self._has_figures(window):
+                    prompts[f"{book_id}#{n}"] = self._build_prompt(book_id, window, next_page)
+                    thinking_budgets[f"{book_id}#{n}"] = self._thinking_budget(window)
+        
+        # Only windows without cached associations go into the batch job
+        cache_keys = {key: self._cache_key(prompt) for key, prompt in prompts.items()}
+        window_associations = {}
+        for key, cache_key in cache_keys.items():
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                window_associations[key] = cached
+        pending = {key: prompt for key, prompt in prompts.items() if key not in window_associations}
+        logger.info(f"{len(window_associations)} windows served from cache, {len(pending)} submitted to batch")
+        
+        # A failed job marks only its windows' books failed; every book is still merged and saved
+        responses = {}
+        batch_error = None
+        if pending:
+            try:
+                responses = await asyncio.to_thread(self._submit_batch, pending, thinking_budgets)
+            except Exception as e:
+                logger.error(f"Batch job failed for {len(pending)} windows: {e}")
+                batch_error = f"Batch job failed: {e}"
+        
+        for key, response_text in responses.items():
+            book_id = key.rsplit('#', 1)[0]
+            try:
+                associations = self._parse_response_text(response_text)
+                window_associations[key] = self._tag_and_cache(book_id, cache_keys[key], associations)
+            except Exception as e:
+                logger.error(f"Error parsing batch response for {key}: {e}")
+                self._failed_books[book_id] = str(e) or repr(e)
+        for key in pending.keys() - responses.keys():
+            self._failed_books[key.rsplit('#', 1)[0]] = batch_error or f"No response in batch output for {key}"
+        
+        for book_id, (pages, windows) in book_windows.items():
+            window_results = [window_associations.get(f"{book_id}#{n}", []) for n in range(len(windows))]
+            associations = self._merge_window_associations(windows, window_results)
+            book_results[book_id] = self._build_book_result(book_id, pages, associations)
+        
+        for book_id, book_result in book_results.items():
+            self._queue_book_result(output_path, book_id, book_result)
+        
+        return book_results
+    
+    async def process_input(self, input_path: str, output_dir: str, use_batch: bool = False) -> Dict:
+        """Process input directory containing page directories, as one batch job or several books concurrently"""
         input_path = Path(input_path)
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
+        (output_path / "failed").mkdir(exist_ok=True)
+        self._failed_books = {}
         
         if not input_path.exists():
             return {"error": f"Input path not found: {input_path}"}
@@ -418,32 +969,39 @@ IMPORTANT (output hygiene):
             "books": {}
         }
         
-        for book_id, page_dirs in books.items():
+        if use_batch:
+            results["books"] = await self._process_books_batch(books, output_path)
+        else:
+            # Gemini calls from all books and windows share one limit
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._preamble_cache_lock = asyncio.Lock()
+            await self._open_preamble_cache()
+            book_ids = list(books)
             try:
-                book_result = self.process_book(book_id, page_dirs)
-                results["books"][book_id] = book_result
-                
-                # Save individual book result
-                book_output_file = output_path / f"{book_id}_portrait_associations.json"
-                with open(book_output_file, 'w', encoding='utf-8') as f:
-                    json.dump(book_result, f, indent=2, ensure_ascii=False)
-                
-                logger.info(f"Saved results for {book_id} to {book_output_file}")
-                
-                # Brief pause between books
-                time.sleep(2)
-                
-            except Exception as e:
-                logger.error(f"Error processing book {book_id}: {e}")
-                results["books"][book_id] = {
-                    "error": str(e),
-                    "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                }
+                book_results = await asyncio.gather(
+                    *(self._process_and_save_book(book_id, books[book_id], output_path) for book_id in book_ids),
+                    return_exceptions=True,
+                )
+            finally:
+                await self._close_preamble_cache()
+            
+            for book_id, book_result in zip(book_ids, book_results):
+                if isinstance(book_result, Exception):
+                    logger.error(f"Error processing book {book_id}: {book_result}")
+                    results["books"][book_id] = {
+                        "error": str(book_result),
+                        "processing_timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+                    }
+                else:
+                    results["books"][book_id] = book_result
+        
+        # Make sure every per-book file is on disk before the combined results
+        await asyncio.to_thread(self._write_queue.join)
         
         # Save combined results
         combined_output = output_path / "all_books_portrait_associations.json"
-        with open(combined_output, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        with open(combined_output, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         
         return results
 
@@ -456,6 +1014,20 @@ def main():
     parser.add_argument("output_dir", help="Directory to save results")
     parser.add_argument("--api-key", help="Google Gemini API key", 
                        default=api_key)
+    parser.add_argument("--batch", action="store_true",
+                       help="Submit all page windows as one Gemini Batch API job (cheaper, slower)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS,
+                       help="Maximum number of concurrent Gemini requests")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                       help="Directory for cached Gemini results")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Always call the API and do not cache results")
+    parser.add_argument("--max-thinking", type=int, default=THINKING_BUDGET,
+                       help="Upper bound on the per-window Gemini thinking budget")
+    parser.add_argument("--repair-json", action="store_true",
+                       help="Try regex-based JSON repair when a response does not parse")
+    parser.add_argument("--no-condense", action="store_true",
+                       help="Send full page markdown instead of only the lines around figures and names")
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
     
     args = parser.parse_args()
@@ -473,13 +1045,16 @@ def main():
     
     # Initialize associator
     try:
-        associator = BookPortraitAssociator(api_key=args.api_key)
+        associator = BookPortraitAssociator(api_key=args.api_key, max_concurrency=args.concurrency,
+                                            cache_dir=None if args.no_cache else args.cache_dir,
+                                            condense=not args.no_condense, max_thinking=args.max_thinking,
+                                            repair_json=args.repair_json)
         
         logger.info(f"Processing input: {args.input_path}")
         logger.info(f"Using Google Gemini model: {associator.model}")
         
         # Process the input
-        results = associator.process_input(args.input_path, args.output_dir)
+        results = asyncio.run(associator.process_input(args.input_path, args.output_dir, use_batch=args.batch))
         
         # Print summary
         if "books" in results:
@@ -10,43 +10,52 @@ from magic_pdf.libs.clean_memory import clean_memory
 from magic_pdf.operators.models_llm import InferenceResultLLM
         
 
-def doc_analyze_llm(
-    dataset: Dataset,
-    MonkeyOCR_model,
-    start_page_id=0,
-    end_page_id=None,
-) -> InferenceResultLLM:
+def _collect_page_images(dataset: Dataset, start_page_id: int, end_page_id: int):
+    """Render a dataset's pages; returns the images to analyze and (page_info, analyzed) for every page."""
+    images = []
+    pages = []
+    for index in range(len(dataset)):
+        img_dict = dataset.get_page(index).get_image()
+        analyzed = start_page_id <= index <= end_page_id
+        if analyzed:
+            images.append(img_dict['img'])
+        pages.append(({'page_no': index, 'height': img_dict['height'], 'width': img_dict['width']}, analyzed))
+    return images, pages
 
-    end_page_id = end_page_id if end_page_id else len(dataset) - 1
+
+def _analyze_datasets(
+    ranges: list[tuple[Dataset, int, int]],
+    MonkeyOCR_model,
+) -> list[InferenceResultLLM]:
+    """Analyze the (dataset, start_page_id, end_page_id) ranges in one batch and split the results per dataset."""
 
     device = MonkeyOCR_model.device
 
     batch_model = BatchAnalyzeLLM(model=MonkeyOCR_model)
 
-    model_json = []
     doc_analyze_start = time.time()
 
     images = []
-    for index in range(len(dataset)):
-        if start_page_id <= index <= end_page_id:
-            page_data = dataset.get_page(index)
-            img_dict = page_data.get_image()
-            images.append(img_dict['img'])
-    analyze_result = batch_model(images)
+    dataset_pages = []
+    for dataset, start_page_id, end_page_id in ranges:
+        dataset_images, pages = _collect_page_images(dataset, start_page_id, end_page_id)
+        images.extend(dataset_images)
+        dataset_pages.append(pages)
+    analyze_result = batch_model(images) if images else []
 
-    for index in range(len(dataset)):
-        page_data = dataset.get_page(index)
-        img_dict = page_data.get_image()
-        page_width = img_dict['width']
-        page_height = img_dict['height']
-        if start_page_id <= index <= end_page_id:
-            result = analyze_result.pop(0)
-        else:
-            result = []
-
-        page_info = {'page_no': index, 'height': page_height, 'width': page_width}
-        page_dict = {'layout_dets': result, 'page_info': page_info}
-        model_json.append(page_dict)
+    # Results come back in page order, so each dataset owns the next entries for its analyzed pages
+    inference_results = []
+    offset = 0
+    for (dataset, _, _), pages in zip(ranges, dataset_pages):
+        model_json = []
+        for page_info, analyzed in pages:
+            if analyzed:
+                result = analyze_result[offset]
+                offset += 1
+            else:
+                result = []
+            model_json.append({'layout_dets': result, 'page_info': page_info})
+        inference_results.append(InferenceResultLLM(model_json, dataset))
 
     gc_start = time.time()
     clean_memory(device)
@@ -54,10 +63,31 @@ def doc_analyze_llm(
     logger.info(f'gc time: {gc_time}')
 
     doc_analyze_time = round(time.time() - doc_analyze_start, 2)
-    doc_analyze_speed = round((end_page_id + 1 - start_page_id) / doc_analyze_time, 2)
+    doc_analyze_speed = round(len(images) / doc_analyze_time, 2) if doc_analyze_time else 0
     logger.info(
-        f'doc analyze time: {round(time.time() - doc_analyze_start, 2)},'
-        f'speed: {doc_analyze_speed} pages/second'
+        f'doc analyze time: {doc_analyze_time}, '
+        f'speed: {doc_analyze_speed} pages/second ({len(ranges)} documents)'
     )
 
-    return InferenceResultLLM(model_json, dataset)
+    return inference_results
+
+
+def doc_analyze_llm(
+    dataset: Dataset,
+    MonkeyOCR_model,
+    start_page_id=0,
+    end_page_id=None,
+) -> InferenceResultLLM:
+
+    end_page_id = end_page_id if end_page_id else len(dataset) - 1
+
+    return _analyze_datasets([(dataset, start_page_id, end_page_id)], MonkeyOCR_model)[0]
+
+
+def doc_analyze_llm_batch(
+    datasets: list[Dataset],
+    MonkeyOCR_model,
+) -> list[InferenceResultLLM]:
+    """Analyze all pages of several datasets in one batch and split the results per dataset."""
+
+    return _analyze_datasets([(dataset, 0, len(dataset) - 1) for dataset in datasets], MonkeyOCR_model)
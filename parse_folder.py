@@ -8,27 +8,70 @@ os.environ['LMDEPLOY_BACKEND'] = 'pytorch'
 os.environ['TRANSFORMERS_BACKEND'] = '1'
 # Disable FlashAttention2 if not available
 os.environ['DISABLE_FLASH_ATTN'] = '1'
-# Set CUDA memory allocation configuration
-os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
+# Set CUDA memory allocation configuration (limit block splitting and let the allocator
+# reclaim cached blocks on its own before OOM); a value already in the environment wins
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512,garbage_collection_threshold:0.8')
 import time
 import argparse
 import sys
 from pathlib import Path
 import glob
 import gc
-import torch
-from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
-from magic_pdf.data.dataset import PymuDocDataset, ImageDataset
-from magic_pdf.model.doc_analyze_by_custom_model_llm import doc_analyze_llm
-from magic_pdf.model.custom_model import MonkeyOCR
+import queue
+import threading
+from contextlib import ExitStack, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
+# torch and magic_pdf are imported by _lazy_imports() once processing starts,
+# so --help and input errors don't pay for torch/CUDA initialization
+torch = None
 
-def clear_cache_memory():
-    """Clear GPU cache and run garbage collection without unloading model"""
+# Release cached GPU blocks only when this much reserved memory is sitting unused
+CACHE_RELEASE_THRESHOLD_BYTES = 2 * 1024**3
+
+# Input file types (lowercase, with the dot) and the stateless reader shared by all files (set by _lazy_imports)
+SUPPORTED_EXTENSIONS = frozenset(['.pdf', '.jpg', '.jpeg', '.png', '.tiff', '.tif', '.bmp'])
+FILE_READER = None
+
+# --dtype choices -> torch dtype attribute names
+AUTOCAST_DTYPES = {"bf16": "bfloat16", "fp16": "float16", "fp32": None}
+
+# Files read ahead of the GPU, and threads writing finished markdown/JSON results
+PREFETCH_DEPTH = 2
+SAVE_WORKERS = 2
+
+
+def _lazy_imports():
+    """Import torch and magic_pdf into the module namespace (first call only)"""
+    global torch, FileBasedDataWriter, FileBasedDataReader, PymuDocDataset, ImageDataset
+    global doc_analyze_llm, doc_analyze_llm_batch, MonkeyOCR, FILE_READER
+    if FILE_READER is not None:
+        return
+    import torch
+    from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
+    from magic_pdf.data.dataset import PymuDocDataset, ImageDataset
+    from magic_pdf.model.doc_analyze_by_custom_model_llm import doc_analyze_llm, doc_analyze_llm_batch
+    from magic_pdf.model.custom_model import MonkeyOCR
+    FILE_READER = FileBasedDataReader()
+
+
+def clear_cache_memory(force=False):
+    """
+    Release cached GPU memory without unloading model
+    
+    Args:
+        force: Run garbage collection and always empty the CUDA cache (and synchronize);
+            otherwise only empty it when reserved-but-unallocated memory exceeds
+            CACHE_RELEASE_THRESHOLD_BYTES
+    """
+    if force:
+        gc.collect()
     if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
-    gc.collect()
+        if force:
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+        elif torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > CACHE_RELEASE_THRESHOLD_BYTES:
+            torch.cuda.empty_cache()
 
 
 def print_memory_stats():
@@ -39,36 +82,226 @@ def print_memory_stats():
         print(f"GPU Memory - Allocated: {allocated:.2f}GB, Reserved: {reserved:.2f}GB")
 
 
-def is_already_processed(input_file, output_dir):
+def resolve_autocast_dtype(dtype, device):
+    """
+    Map a --dtype choice to the torch dtype used for autocast
+    
+    Args:
+        dtype: One of AUTOCAST_DTYPES ("bf16", "fp16", "fp32")
+        device: The model's configured device (e.g. "cuda", "cuda:1", "cpu", "mps")
+    
+    Returns:
+        torch.dtype or None: None disables autocast (fp32 or a non-CUDA device)
+    """
+    if AUTOCAST_DTYPES[dtype] is None or not str(device).startswith("cuda") or not torch.cuda.is_available():
+        return None
+    torch_dtype = getattr(torch, AUTOCAST_DTYPES[dtype])
+    if torch_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        print("⚠️ bf16 is not supported on this GPU, using fp16")
+        return torch.float16
+    return torch_dtype
+
+
+def autocast_context(autocast_dtype):
+    """CUDA autocast for the given dtype, or a no-op context when it is None"""
+    if autocast_dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type="cuda", dtype=autocast_dtype)
+
+
+def inference_context(autocast_dtype):
+    """Context for model calls: inference mode (no autograd tracking) plus optional autocast"""
+    stack = ExitStack()
+    stack.enter_context(torch.inference_mode())
+    stack.enter_context(autocast_context(autocast_dtype))
+    return stack
+
+
+def compile_model(model):
+    """
+    Compile the model's torch submodules in place (CUDA only)
+    
+    The transformers chat backend gets a static KV cache and a CUDA-graph compiled
+    forward; the layout reader is compiled for dynamic box counts. LMDeploy/vLLM
+    backends and the YOLO layout model manage their own kernels and are left alone.
+    
+    Args:
+        model: Loaded MonkeyOCR model instance
+    """
+    if not torch.cuda.is_available():
+        print("⚠️ torch.compile skipped: CUDA is not available")
+        return
+    
+    chat_model = getattr(model, "chat_model", None)
+    if isinstance(getattr(chat_model, "model", None), torch.nn.Module):
+        chat_model.model.generation_config.cache_implementation = "static"
+        chat_model.model.forward = torch.compile(chat_model.model.forward, mode="reduce-overhead", fullgraph=False)
+        print("Compiled VLM forward with static KV cache")
+    
+    if isinstance(getattr(model, "layoutreader_model", None), torch.nn.Module):
+        model.layoutreader_model.forward = torch.compile(model.layoutreader_model.forward, dynamic=True)
+        print("Compiled layout reader")
+
+
+def scan_output_dir(output_dir):
+    """
+    List the output directory once so skip checks need no further syscalls
+    
+    Args:
+        output_dir: Output directory
+    
+    Returns:
+        dict: Subdirectory name -> set of file names in it (empty if output_dir is missing)
+    """
+    existing_outputs = {}
+    try:
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    existing_outputs[entry.name] = set(os.listdir(entry.path))
+    except FileNotFoundError:
+        pass
+    return existing_outputs
+
+
+def file_stem(input_file):
+    """Output name for an input file: its base name without the last extension ("my.v2.pdf" -> "my.v2")"""
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+
+def is_already_processed(input_file, output_dir, existing_outputs=None, name_without_suff=None):
     """
     Check if a file has already been processed by looking for output files
     
     Args:
         input_file: Input file path
         output_dir: Output directory
+        existing_outputs: Listing from scan_output_dir; the directory is read if None
+        name_without_suff: Precomputed file_stem(input_file)
     
     Returns:
         bool: True if already processed, False otherwise
     """
-    name_without_suff = os.path.basename(input_file).split(".")[0]
+    if name_without_suff is None:
+        name_without_suff = file_stem(input_file)
+    expected_files = {
+        f"{name_without_suff}.md",
+        f"{name_without_suff}_content_list.json",
+        f"{name_without_suff}_middle.json"
+    }
+    
+    if existing_outputs is not None:
+        return expected_files.issubset(existing_outputs.get(name_without_suff, ()))
+    
+    # Check if output directory exists and has all expected files
+    try:
+        with os.scandir(os.path.join(output_dir, name_without_suff)) as entries:
+            names = {entry.name for entry in entries}
+    except FileNotFoundError:
+        return False
+    return expected_files.issubset(names)
+
+
+def load_dataset(input_file, file_bytes=None):
+    """
+    Wrap a file in the dataset type matching its extension
+    
+    Args:
+        input_file: Input file path
+        file_bytes: Prefetched file contents (read here if None)
+    
+    Returns:
+        PymuDocDataset or ImageDataset
+    """
+    # Read as one bytes object on purpose: PyMuPDF only accepts an exact bytes stream and wraps it
+    # without copying, and the pipeline needs the same bytes again (data_bits for the md5 and drawings)
+    if file_bytes is None:
+        file_bytes = FILE_READER.read(input_file)
+    
+    file_extension = input_file.split(".")[-1].lower()
+    if file_extension == "pdf":
+        return PymuDocDataset(file_bytes)
+    return ImageDataset(file_bytes)
+
+
+def prefetch_files(files, output_dir, skip_existing, out_queue, existing_outputs=None):
+    """
+    Producer thread: read input files ahead of inference and queue (file, bytes) pairs
+    
+    Only the raw bytes are read here; the PyMuPDF document is opened on the inference
+    thread, since PyMuPDF must not be used from several threads at once. Skipped or
+    unreadable files are queued with bytes None; parse_single_file then reports the
+    skip or retries the read and reports the error. A final None marks the end of the input.
+    """
+    for input_file in files:
+        file_bytes = None
+        if not (skip_existing and is_already_processed(input_file, output_dir, existing_outputs)):
+            try:
+                file_bytes = FILE_READER.read(input_file)
+            except Exception:
+                pass
+        out_queue.put((input_file, file_bytes))
+    out_queue.put(None)
+
+
+def draw_results(infer_result, pipe_result, local_md_dir, name_without_suff):
+    """Write the PDF visualizations for a parsed file (PyMuPDF; call on the inference thread)"""
+    infer_result.draw_model(os.path.join(local_md_dir, f"{name_without_suff}_model.pdf"))
+    pipe_result.draw_layout(os.path.join(local_md_dir, f"{name_without_suff}_layout.pdf"))
+    pipe_result.draw_span(os.path.join(local_md_dir, f"{name_without_suff}_spans.pdf"))
+
+
+def save_results(pipe_result, local_md_dir, image_dir, name_without_suff):
+    """Write markdown and JSON outputs for a parsed file (no model or PyMuPDF access)"""
+    md_writer = FileBasedDataWriter(local_md_dir)
+    
+    # Runs on a save_executor worker, so the dumps already overlap inference; a failing dump
+    # raises into the save future and the file is reported as failed
+    pipe_result.dump_md(md_writer, f"{name_without_suff}.md", image_dir)
+    pipe_result.dump_content_list(md_writer, f"{name_without_suff}_content_list.json", image_dir)
+    pipe_result.dump_middle_json(md_writer, f'{name_without_suff}_middle.json')
+
+
+def prepare_output_dirs(name_without_suff, output_dir):
+    """
+    Create the output directories for a file
+    
+    Returns:
+        tuple: (local_md_dir, local_image_dir)
+    """
+    local_image_dir = os.path.join(output_dir, name_without_suff, "images")
     local_md_dir = os.path.join(output_dir, name_without_suff)
+    os.makedirs(local_image_dir, exist_ok=True)  # also creates local_md_dir
+    print(f"Output dir: {local_md_dir}")
+    return local_md_dir, local_image_dir
+
+
+def pipe_and_save(infer_result, name_without_suff, output_dir, model, save_executor=None):
+    """
+    Run the OCR pipeline on an inference result and save the outputs
     
-    # Check if output directory exists and has expected files
-    if os.path.exists(local_md_dir):
-        expected_files = [
-            f"{name_without_suff}.md",
-            f"{name_without_suff}_content_list.json",
-            f"{name_without_suff}_middle.json"
-        ]
-        
-        # Check if all expected files exist
-        all_exist = all(os.path.exists(os.path.join(local_md_dir, f)) for f in expected_files)
-        return all_exist
+    Returns:
+        tuple: (output dir, future of the pending save, or None if saved synchronously)
+    """
+    local_md_dir, local_image_dir = prepare_output_dirs(name_without_suff, output_dir)
+    image_dir = os.path.basename(local_image_dir)
+    image_writer = FileBasedDataWriter(local_image_dir)
     
-    return False
+    # Pipeline processing
+    pipe_result = infer_result.pipe_ocr_mode(image_writer, MonkeyOCR_model=model)
+    
+    # Drawings use PyMuPDF, which must stay on this thread
+    draw_results(infer_result, pipe_result, local_md_dir, name_without_suff)
+    
+    # Save results; with an executor the dumps overlap inference on the next file
+    if save_executor is not None:
+        return local_md_dir, save_executor.submit(save_results, pipe_result, local_md_dir, image_dir, name_without_suff)
+    save_results(pipe_result, local_md_dir, image_dir, name_without_suff)
+    return local_md_dir, None
 
 
-def parse_single_file(input_file, output_dir, model, file_count, total_files, skip_existing=True, show_memory=False):
+def parse_single_file(input_file, output_dir, model, file_count, total_files, skip_existing=True, show_memory=False,
+                      file_bytes=None, save_executor=None, existing_outputs=None, autocast_dtype=None):
     """
     Parse a single file and save results (reuses loaded model)
     
@@ -80,82 +313,112 @@ def parse_single_file(input_file, output_dir, model, file_count, total_files, sk
         total_files: Total number of files
         skip_existing: Skip files that have already been processed
         show_memory: Show memory usage information
+        file_bytes: Prefetched contents of input_file (read here if None)
+        save_executor: Executor to write outputs on; saved synchronously if None
+        existing_outputs: Output directory listing from scan_output_dir, for the skip check
+        autocast_dtype: Reduced-precision dtype to run inference under (None for fp32)
+    
+    Returns:
+        tuple: (success, output dir or None if skipped/failed, future of the pending save or None)
     """
     print(f"\n[{file_count}/{total_files}] Processing: {os.path.basename(input_file)}")
+    name_without_suff = file_stem(input_file)
     
     # Check if already processed
-    if skip_existing and is_already_processed(input_file, output_dir):
+    if skip_existing and is_already_processed(input_file, output_dir, existing_outputs, name_without_suff):
         print(f"⏭️ [{file_count}/{total_files}] Skipping (already processed): {os.path.basename(input_file)}")
-        return True, None
-    
-    # Clear cache before processing each file
-    clear_cache_memory()
+        return True, None, None
     
     if show_memory:
         print_memory_stats()
     
     try:
-        # Get filename
-        name_without_suff = os.path.basename(input_file).split(".")[0]
-        
-        # Prepare output directory
-        local_image_dir = os.path.join(output_dir, name_without_suff, "images")
-        local_md_dir = os.path.join(output_dir, name_without_suff)
-        image_dir = os.path.basename(local_image_dir)
-        os.makedirs(local_image_dir, exist_ok=True)
-        os.makedirs(local_md_dir, exist_ok=True)
-        
-        print(f"Output dir: {local_md_dir}")
-        image_writer = FileBasedDataWriter(local_image_dir)
-        md_writer = FileBasedDataWriter(local_md_dir)
-        
-        # Read file content
-        reader = FileBasedDataReader()
-        file_bytes = reader.read(input_file)
-        
-        # Create dataset instance
-        file_extension = input_file.split(".")[-1].lower()
-        if file_extension == "pdf":
-            ds = PymuDocDataset(file_bytes)
-        else:
-            ds = ImageDataset(file_bytes)
+        # Create dataset instance from the prefetched bytes if there are any
+        ds = load_dataset(input_file, file_bytes)
         
         # Start inference
         print("Performing document parsing...")
         start_time = time.time()
         
-        infer_result = ds.apply(doc_analyze_llm, MonkeyOCR_model=model)
-        
-        # Pipeline processing
-        pipe_result = infer_result.pipe_ocr_mode(image_writer, MonkeyOCR_model=model)
+        with inference_context(autocast_dtype):
+            infer_result = ds.apply(doc_analyze_llm, MonkeyOCR_model=model)
+            local_md_dir, save_future = pipe_and_save(infer_result, name_without_suff, output_dir, model, save_executor)
         
         parsing_time = time.time() - start_time
         print(f"Parsing time: {parsing_time:.2f}s")
-
-        # Save results
-        infer_result.draw_model(os.path.join(local_md_dir, f"{name_without_suff}_model.pdf"))
-        pipe_result.draw_layout(os.path.join(local_md_dir, f"{name_without_suff}_layout.pdf"))
-        pipe_result.draw_span(os.path.join(local_md_dir, f"{name_without_suff}_spans.pdf"))
-        pipe_result.dump_md(md_writer, f"{name_without_suff}.md", image_dir)
-        pipe_result.dump_content_list(md_writer, f"{name_without_suff}_content_list.json", image_dir)
-        pipe_result.dump_middle_json(md_writer, f'{name_without_suff}_middle.json')
-        
-        print(f"✅ [{file_count}/{total_files}] Successfully processed: {os.path.basename(input_file)} ({parsing_time:.1f}s)")
         
-        # Clean up intermediate results but keep model
-        del infer_result
-        del pipe_result
-        del ds
-        del file_bytes
-        clear_cache_memory()
-        
-        return True, local_md_dir
+        if save_future is None:
+            print(f"✅ [{file_count}/{total_files}] Successfully processed: {os.path.basename(input_file)} ({parsing_time:.1f}s)")
+        return True, local_md_dir, save_future
         
     except Exception as e:
         print(f"❌ [{file_count}/{total_files}] Failed to process {os.path.basename(input_file)}: {str(e)}")
-        # Clean up on error
-        clear_cache_memory()
-        return False, None
+        return False, None, None
+
+
+def parse_file_batch(batch, output_dir, model, total_files, skip_existing=True, show_memory=False, save_executor=None,
+                     existing_outputs=None, autocast_dtype=None):
+    """
+    Parse several files with one batched inference call over all their pages
+    
+    Args:
+        batch: List of (file number, input file path, prefetched bytes or None)
+        output_dir: Output directory
+        model: Pre-loaded MonkeyOCR model instance
+        total_files: Total number of files
+        skip_existing: Skip files that have already been processed
+        show_memory: Show memory usage information
+        save_executor: Executor to write outputs on; saved synchronously if None
+        existing_outputs: Output directory listing from scan_output_dir, for the skip check
+        autocast_dtype: Reduced-precision dtype to run inference under (None for fp32)
+    
+    Returns:
+        list: (success, output dir or None if skipped/failed, future of the pending save or None) per file
+    """
+    results = [None] * len(batch)
+    to_infer = []  # (position in batch, file number, input file, dataset)
+    for pos, (file_count, input_file, file_bytes) in enumerate(batch):
+        print(f"\n[{file_count}/{total_files}] Processing: {os.path.basename(input_file)}")
+        if skip_existing and is_already_processed(input_file, output_dir, existing_outputs):
+            print(f"⏭️ [{file_count}/{total_files}] Skipping (already processed): {os.path.basename(input_file)}")
+            results[pos] = (True, None, None)
+            continue
+        try:
+            to_infer.append((pos, file_count, input_file, load_dataset(input_file, file_bytes)))
+        except Exception as e:
+            print(f"❌ [{file_count}/{total_files}] Failed to process {os.path.basename(input_file)}: {str(e)}")
+            results[pos] = (False, None, None)
+    
+    if not to_infer:
+        return results
+    
+    if show_memory:
+        print_memory_stats()
+    
+    print(f"Performing document parsing on {len(to_infer)} files in one batch...")
+    start_time = time.time()
+    try:
+        with inference_context(autocast_dtype):
+            infer_results = doc_analyze_llm_batch([ds for _, _, _, ds in to_infer], MonkeyOCR_model=model)
+    except Exception as e:
+        print(f"❌ Batch inference failed for {len(to_infer)} files: {str(e)}")
+        for pos, _, _, _ in to_infer:
+            results[pos] = (False, None, None)
+        return results
+    
+    for (pos, file_count, input_file, _), infer_result in zip(to_infer, infer_results):
+        try:
+            with inference_context(autocast_dtype):
+                local_md_dir, save_future = pipe_and_save(infer_result, file_stem(input_file), output_dir, model, save_executor)
+            if save_future is None:
+                print(f"✅ [{file_count}/{total_files}] Successfully processed: {os.path.basename(input_file)}")
+            results[pos] = (True, local_md_dir, save_future)
+        except Exception as e:
+            print(f"❌ [{file_count}/{total_files}] Failed to process {os.path.basename(input_file)}: {str(e)}")
+            results[pos] = (False, None, None)
+    
+    print(f"Parsing time: {time.time() - start_time:.2f}s for {len(to_infer)} files")
+    return results
 
 
 def get_supported_files(input_path, extensions=None):
@@ -164,31 +427,28 @@ def get_supported_files(input_path, extensions=None):
     
     Args:
         input_path: Input file or directory path
-        extensions: List of supported extensions
+        extensions: Supported extensions (default: SUPPORTED_EXTENSIONS)
     """
-    if extensions is None:
-        extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.tiff', '.tif', '.bmp']
-    
+    exts = SUPPORTED_EXTENSIONS if extensions is None else frozenset(extensions)
     files = []
     
     if os.path.isfile(input_path):
         # Single file
-        if any(input_path.lower().endswith(ext) for ext in extensions):
+        if os.path.splitext(input_path)[1].lower() in exts:
             files.append(input_path)
     elif os.path.isdir(input_path):
-        # Directory - get all supported files (case-insensitive)
-        for file_path in Path(input_path).iterdir():
-            if file_path.is_file():
-                file_ext = file_path.suffix.lower()
-                if file_ext in extensions:
-                    files.append(str(file_path))
-    
-    # Remove duplicates and sort
-    files = sorted(list(set(files)))
+        # Directory - get all supported files (case-insensitive); dirent types avoid a stat per entry
+        with os.scandir(input_path) as entries:
+            for entry in entries:
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts:
+                    files.append(entry.path)
+    
+    files.sort()
     return files
 
 
-def process_files(input_path, output_dir, config_path, clear_interval=5, skip_existing=True, show_memory=False):
+def process_files(input_path, output_dir, config_path, clear_interval=5, skip_existing=True, show_memory=False, batch_files=1,
+                  compile=False, dtype="bf16"):
     """
     Process files (single file or directory) with model reuse and memory management
     
@@ -199,6 +459,9 @@ def process_files(input_path, output_dir, config_path, clear_interval=5, skip_ex
         clear_interval: Number of files to process before aggressive memory clearing (default: 5)
         skip_existing: Skip files that have already been processed (default: True)
         show_memory: Show memory usage information
+        batch_files: Number of files whose pages share one inference call (default: 1)
+        compile: Compile the model with torch.compile after loading (default: False)
+        dtype: Inference precision, one of "bf16", "fp16", "fp32" (default: "bf16")
     """
     # Check if input exists
     if not os.path.exists(input_path):
@@ -219,12 +482,26 @@ def process_files(input_path, output_dir, config_path, clear_interval=5, skip_ex
     
     # Load model once
     print("\nLoading MonkeyOCR model...")
+    _lazy_imports()
     model_start_time = time.time()
     try:
         MonkeyOCR_model = MonkeyOCR(config_path)
+        torch.set_grad_enabled(False)  # nothing in this process trains
         model_load_time = time.time() - model_start_time
         print(f"✅ Model loaded successfully in {model_load_time:.2f}s")
         
+        # Run the layout reader in the inference precision (MonkeyOCR loads it in bf16 when supported,
+        # so fp32 casts it back); autocast covers the rest. Other devices keep the model as loaded
+        autocast_dtype = resolve_autocast_dtype(dtype, MonkeyOCR_model.device)
+        if str(MonkeyOCR_model.device).startswith("cuda") and isinstance(getattr(MonkeyOCR_model, "layoutreader_model", None), torch.nn.Module):
+            MonkeyOCR_model.layoutreader_model.to(dtype=autocast_dtype or torch.float32)
+        
+        if compile:
+            compile_model(MonkeyOCR_model)
+        
+        # Move the model's long-lived objects out of the generational GC's scans
+        gc.freeze()
+        
         if show_memory:
             print_memory_stats()
             
@@ -239,38 +516,96 @@ def process_files(input_path, output_dir, config_path, clear_interval=5, skip_ex
     total_parsing_time = 0
     total_start_time = time.time()
     
+    # One listing of the output directory serves every skip check
+    existing_outputs = scan_output_dir(output_dir) if skip_existing else None
+    
+    # Files are read by a producer thread while the GPU works on the previous file,
+    # and markdown/JSON outputs are written on a small pool while it works on the next one
+    prefetch_queue = queue.Queue(maxsize=max(PREFETCH_DEPTH, batch_files))
+    threading.Thread(
+        target=prefetch_files,
+        args=(files_to_process, output_dir, skip_existing, prefetch_queue, existing_outputs),
+        daemon=True,
+    ).start()
+    save_executor = ThreadPoolExecutor(max_workers=SAVE_WORKERS)
+    pending_saves = []  # (file number, file path, future) in submission order
+    
+    def finish_save(file_count, file_path, save_future):
+        """Wait for a pending save and correct the counters if it failed"""
+        nonlocal successful, failed
+        try:
+            save_future.result()
+            print(f"✅ [{file_count}/{len(files_to_process)}] Successfully processed: {os.path.basename(file_path)}")
+        except Exception as e:
+            print(f"❌ [{file_count}/{len(files_to_process)}] Failed to save {os.path.basename(file_path)}: {str(e)}")
+            successful -= 1
+            failed += 1
+    
     try:
-        for i, file_path in enumerate(files_to_process, 1):
-            file_start_time = time.time()
-            success, result_dir = parse_single_file(file_path, output_dir, MonkeyOCR_model, i, len(files_to_process), skip_existing, show_memory)
-            file_time = time.time() - file_start_time
+        i = 0
+        while i < len(files_to_process):
+            # Take the next batch_files files off the prefetch queue
+            batch = []
+            while len(batch) < batch_files and i < len(files_to_process):
+                i += 1
+                file_path, file_bytes = prefetch_queue.get()
+                batch.append((i, file_path, file_bytes))
             
-            if success:
-                if result_dir is None:  # File was skipped
-                    skipped += 1
-                else:
-                    successful += 1
-                    total_parsing_time += file_time
+            batch_start_time = time.time()
+            if batch_files == 1:
+                file_count, file_path, file_bytes = batch[0]
+                batch_results = [parse_single_file(file_path, output_dir, MonkeyOCR_model, file_count, len(files_to_process),
+                                                   skip_existing, show_memory, file_bytes=file_bytes, save_executor=save_executor,
+                                                   existing_outputs=existing_outputs, autocast_dtype=autocast_dtype)]
             else:
-                failed += 1
+                batch_results = parse_file_batch(batch, output_dir, MonkeyOCR_model, len(files_to_process),
+                                                 skip_existing, show_memory, save_executor=save_executor,
+                                                 existing_outputs=existing_outputs, autocast_dtype=autocast_dtype)
+            del batch, file_bytes  # drop our references to the inputs before the next files are read
+            batch_time = time.time() - batch_start_time
             
-            # More aggressive memory clearing at intervals
-            if i % clear_interval == 0:
+            processed = [result for result in batch_results if result[0] and result[1] is not None]
+            for file_count, (success, result_dir, save_future) in zip(range(i - len(batch_results) + 1, i + 1), batch_results):
+                if success:
+                    if result_dir is None:  # File was skipped
+                        skipped += 1
+                    else:
+                        successful += 1
+                        total_parsing_time += batch_time / len(processed)
+                else:
+                    failed += 1
+                
+                # Bound the results held in memory by the save backlog
+                if save_future is not None:
+                    pending_saves.append((file_count, files_to_process[file_count - 1], save_future))
+            while pending_saves and (pending_saves[0][2].done() or len(pending_saves) > SAVE_WORKERS):
+                finish_save(*pending_saves.pop(0))
+            
+            # The file's intermediates went out of scope when parse returned; release the GPU cache
+            # if that left it fragmented, and more aggressively at intervals
+            if i % clear_interval < len(batch_results):
                 print(f"🧹 Performing aggressive memory cleanup after {i} files...")
-                clear_cache_memory()
+                clear_cache_memory(force=True)
                 if show_memory:
                     print_memory_stats()
-                time.sleep(2)  # Brief pause to ensure cleanup
+            else:
+                clear_cache_memory()
         
     except KeyboardInterrupt:
         print("\n⚠️ Processing interrupted by user")
     except Exception as e:
         print(f"\n❌ Processing error: {str(e)}")
     finally:
+        # Let queued writes finish before tearing down
+        for pending in pending_saves:
+            finish_save(*pending)
+        save_executor.shutdown(wait=True)
+        
         # Clean up model
         print("\nCleaning up model...")
         del MonkeyOCR_model
-        clear_cache_memory()
+        gc.unfreeze()
+        clear_cache_memory(force=True)
     
     total_time = time.time() - total_start_time
     
@@ -313,6 +648,9 @@ Usage examples:
   # With custom config and memory management
   python parse_folder.py /path/to/directory -c model_configs.yaml --clear-interval 3
   
+  # Batch the pages of 8 files into one inference call (many small images)
+  python parse_folder.py /path/to/directory --batch-files 8
+  
   # Show memory usage information
   python parse_folder.py /path/to/directory --show-memory
         """
@@ -348,6 +686,27 @@ Usage examples:
         help="Reprocess files even if they have already been processed"
     )
     
+    parser.add_argument(
+        "--batch-files",
+        type=int,
+        default=1,
+        help="Number of files whose pages are analyzed in one batched inference call (default: 1)"
+    )
+    
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile (static KV cache; first files run slower while compiling)"
+    )
+    
+    parser.add_argument(
+        "--dtype",
+        choices=list(AUTOCAST_DTYPES),
+        default="bf16",
+        help="Inference precision via CUDA autocast, also applied to the layout reader; CUDA devices only "
+             "(default: bf16, fp16 where bf16 is unsupported)"
+    )
+    
     parser.add_argument(
         "--show-memory",
         action="store_true",
@@ -363,7 +722,10 @@ Usage examples:
             args.config,
             args.clear_interval,
             skip_existing=not args.no_skip_existing,
-            show_memory=args.show_memory
+            show_memory=args.show_memory,
+            batch_files=max(1, args.batch_files),
+            compile=args.compile,
+            dtype=args.dtype
         )
         print(f"\n✅ Processing completed!")
         